@@ -0,0 +1,296 @@
+# batchAnalysis.py
+# Analyzes a directory (or globs) of PicoLog CSV exports and run databases in a process pool
+# Settings per file come from a manifest csv, one row per file name pattern:
+#   pattern,frequency,L,channels,positions,sampling_rate,shift,start,end,density,specific_heat
+#   *_f=0.001.plw_1.csv,0.002,0.71,TC3 TC4,,100,0.68,,,1,1
+# channels are the CSV columns (or database channels) of the TCs, nearest the heater first, and positions
+# their distances from the heater (0 and L for the first two when not given). With more than two TCs every
+# pair and the regression over all positions are reported as well.
+# For databases every run is analyzed with the settings stored with it, a manifest row overrides them. The shift
+# (time difference between TCs) of csv exports is dbSchema's TC_TIME_SHIFT unless the manifest gives one.
+# The frequency is checked against the one the readings oscillate at (a warning in the results when they
+# disagree), --use-estimated-frequency analyzes at the estimate instead.
+# Without a start time the readings before periodic steady state (stored with the run, or found with
+# steadyState for csv exports) are left out.
+# Each result is appended to the results csv as soon as it is done, rerunning skips what is already there.
+# Results are also kept in the fit cache (fitCache), a rerun with the same settings on unchanged files or runs
+# takes them from there instead of analyzing again (--no-cache to always analyze).
+
+import argparse
+import csv
+import fnmatch
+import glob
+import os
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import utils as ut
+import dbSchema as db
+import steadyState as ss
+import fitCache as fc
+
+MANIFEST = 'manifest.csv'
+RESULTS = 'batch_results.csv'
+EXTENSIONS = ('.csv', '.db', '.plw')  # Files picked up from a directory
+WORKERS = os.cpu_count()
+SAMPLING_RATE = 1 / 0.01  # PicoLog export sampling, when the manifest has none
+RESULT_COLUMNS = ['source', 'run', 'frequency', 'L', 'start', 'readings', 'diffusivity', 'conductivity',
+                  'delta_time', 'amplitude_ratio',
+                  'r2_1', 'r2_2', 'amplitude_1', 'amplitude_2', 'phase_1', 'phase_2',
+                  'regression_diffusivity', 'pair_diffusivities', 'diffusivity_low', 'diffusivity_high',
+                  'frequency_estimate', 'warning', 'runtime_s', 'error']
+
+
+def read_manifest(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, newline='') as manifest_file:
+        return [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                for row in csv.DictReader(manifest_file)]
+
+
+def manifest_row(manifest, source):
+    # First row whose pattern matches the file name (or path)
+    for row in manifest:
+        if fnmatch.fnmatch(os.path.basename(source), row['pattern']) or fnmatch.fnmatch(source, row['pattern']):
+            return row
+    return None
+
+
+def find_sources(inputs):
+    sources = []
+    for item in inputs:
+        if os.path.isdir(item):
+            sources += sorted(path for path in glob.glob(os.path.join(item, '*')) if path.lower().endswith(EXTENSIONS))
+        else:
+            sources += sorted(glob.glob(item)) or [item]
+    return list(dict.fromkeys(sources))
+
+
+def make_jobs(sources, manifest):
+    # One job per CSV and per run of each database: source, run and its settings
+    jobs = []
+    for source in sources:
+        row = manifest_row(manifest, source) or {}
+        if source.lower().endswith('.db'):
+            conn = sqlite3.connect(source)
+            cursor = conn.cursor()
+            runs = [db.get_run(cursor, run[0]) for run in db.list_runs(cursor)]
+            conn.close()
+            for run in runs:
+                positions = db.run_positions(run)
+                settings = {'frequency': run['opamp_frequency'], 'L': db.main_pair(run)[2], 'density': run['density'],
+                            'specific_heat': run['specific_heat'], 'sampling_rate': run['sampling_rate'],
+                            'channels': " ".join(str(channel) for channel in positions),
+                            'positions': " ".join(str(position) for position in positions.values()),
+                            'shift': db.run_tc_shift(run)}
+                if run.get('steady_time') is not None:  # Databases from before the column was added
+                    settings['start'] = run['steady_time']
+                settings.update(row)
+                jobs.append({'source': source, 'run': run['run_id'], **settings})
+        else:
+            jobs.append({'source': source, 'run': '', **row})
+    return jobs
+
+
+def load_readings(job):
+    # times and a (samples x TCs) array of the job's TCs
+    channels = job['channels'].split()
+    if job['source'].lower().endswith('.db'):
+        conn = sqlite3.connect(job['source'])
+        cursor = conn.cursor()
+        columns = [np.array(db.readings_since(cursor, int(job['run']), int(channel), -np.inf),
+                            dtype=float).reshape(-1, 2) for channel in channels]
+        conn.close()
+        missing = [channel for channel, column in zip(channels, columns) if not len(column)]
+        if missing:
+            raise ValueError(f"No readings of channel {', '.join(missing)} in run {job['run']}")
+        # Channels are read at their own times (TC3-8 less often when polled), every TC on TC1's times
+        times = columns[0][:, 0]
+        return times, np.column_stack([np.interp(times, column[:, 0], column[:, 1]) for column in columns])
+
+    df = ut.clean_dataframe(pd.read_csv(job['source']))
+    times = np.arange(len(df)) / float(job.get('sampling_rate') or SAMPLING_RATE)
+    return times, df[channels].to_numpy(dtype=float)
+
+
+def analyze_window(times, temps, frequency, positions, shift=0.0, resamples=ut.BOOTSTRAP_RESAMPLES):
+    # Detrend every TC and fit them in one solve, as the dashboard's 'window' mode does for two.
+    # Returns the fits, their adjusted R^2, the diffusivity of every pair, of the position regression
+    # (nan with only two TCs) and the 95% interval of the first pair's. TC k is read k * shift after the first
+    sampling_rate = (len(times) - 1) / (times[-1] - times[0])
+    temps_pr = ut.process_data(temps, sampling_rate, frequency)
+    params, r2 = ut.fit_channels(temps_pr, times, frequency)
+    params[:, 2] -= shift * np.arange(len(params))  # Same as fitting against times + k * shift
+    pairs = ut.pair_diffusivities(params, positions, frequency)
+    regression = ut.position_regression(params, positions, frequency)[0] if len(positions) > 2 else np.nan
+    near, far = np.argsort(positions[:2])  # The first pair, nearer the heater first
+    L = positions[far] - positions[near]
+    interval = (ut.bootstrap_diffusivity(temps_pr[:, near], times + near * shift, temps_pr[:, far],
+                                         times + far * shift, frequency, L, resamples)[0]
+                if resamples else (np.nan, np.nan))
+    return params, r2, pairs, regression, interval
+
+
+def source_fingerprint(job):
+    # Changes when the job's csv file or run readings do
+    if not job['source'].lower().endswith('.db'):
+        return fc.file_fingerprint(job['source'])
+    conn = sqlite3.connect(job['source'])
+    channels = [int(channel) for channel in job['channels'].split()]
+    fingerprint = fc.window_fingerprint(conn.cursor(), int(job['run']), channels, -np.inf, np.inf)
+    conn.close()
+    return fingerprint
+
+
+def analyze(job):
+    # Runs in a worker process, returns one results row (with the error instead if it failed)
+    start_time = time.perf_counter()
+    result = {'source': job['source'], 'run': job['run'], 'frequency': job.get('frequency'), 'L': job.get('L')}
+    cache = None
+    try:
+        if job['source'].lower().endswith('.plw'):
+            raise ValueError("PicoLog .plw files have to be exported to csv in PicoLog first")
+        if 'frequency' not in job or 'L' not in job or 'channels' not in job:
+            raise ValueError("No manifest row with frequency, L and channels for this file")
+
+        # Analyzed before with every setting the same, and the readings unchanged since
+        if job.get('cache'):
+            cache = fc.FitCache(job['cache'])
+            key = {**job, 'source': os.path.abspath(job['source']), 'cache': None}
+            fingerprint = source_fingerprint(job)
+            cached = cache.get(key, fingerprint)
+            if cached is not None:
+                result.update(cached)
+                result['runtime_s'] = time.perf_counter() - start_time
+                cache.close()
+                return result
+
+        frequency, L = float(job['frequency']), float(job['L'])
+        positions = [float(position) for position in job['positions'].split()] if 'positions' in job else [0, L]
+        if len(positions) < 2:
+            raise ValueError("Need the positions of at least two TCs")
+        channels = job['channels'].split()
+        times, temps = load_readings(job)
+        temps = temps[:, :len(positions)]
+
+        # Leave out the heating transient unless a start is given (nothing is left out if it never settles)
+        start = job.get('start')
+        if start is None:
+            start = ss.detect(times, temps, frequency, range(1, len(positions) + 1))
+        start = -np.inf if start is None else float(start)
+        end = float(job.get('end', np.inf))
+        keep = (times >= start) & (times <= end)
+        times, temps = times[keep], temps[keep]
+        if len(times) < 10:
+            raise ValueError(f"Only {len(times)} readings between {start} and {end} s")
+        result['start'] = start if np.isfinite(start) else ''
+
+        # Frequency TC1 oscillates at once settled (the transient's drift would swamp it), a wrong configured
+        # frequency spoils every fit
+        estimated = ut.estimate_frequency(temps[:, 0], (len(times) - 1) / (times[-1] - times[0]))
+        result['frequency_estimate'] = estimated
+        result['warning'] = ut.frequency_warning(frequency, estimated) or ''
+        if job.get('use_estimated_frequency'):
+            frequency = result['frequency'] = estimated
+        shift = float(job.get('shift', db.TC_TIME_SHIFT))
+        params, r2, pairs, regression, interval = analyze_window(times, temps, frequency, positions, shift,
+                                                                 job['resamples'])
+
+        # Main result from the first two TCs, as on the dashboard, the one nearer the heater first
+        # L is the distance between them when positions are given, as dbSchema.main_pair has it for runs
+        near, far = np.argsort(positions[:2])
+        L = result['L'] = positions[far] - positions[near]
+        delta_time, amplitude_ratio, diffusivity, conductivity = ut.calculate_diffusivities(
+            params[near], params[far], frequency, L,
+            float(job.get('density', 1)), float(job.get('specific_heat', 1)))
+        result.update({'readings': len(times), 'diffusivity': diffusivity, 'conductivity': conductivity,
+                       'delta_time': delta_time, 'amplitude_ratio': amplitude_ratio,
+                       'r2_1': r2[0], 'r2_2': r2[1], 'amplitude_1': params[0, 1], 'amplitude_2': params[1, 1],
+                       'phase_1': params[0, 2], 'phase_2': params[1, 2], 'regression_diffusivity': regression,
+                       'pair_diffusivities': " ".join(f"{channels[i]}-{channels[j]}={d}" for i, j, d in pairs),
+                       'diffusivity_low': interval[0], 'diffusivity_high': interval[1]})
+        if cache is not None:
+            cache.put(key, fingerprint, {column: value for column, value in result.items()
+                                         if column not in ('source', 'run')})
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    if cache is not None:
+        cache.close()
+    result['runtime_s'] = time.perf_counter() - start_time
+    return result
+
+
+def done_keys(results_path, retry_errors=False):
+    # (source, run) of the results already written
+    if not os.path.exists(results_path):
+        return set()
+    with open(results_path, newline='') as results_file:
+        return {(row['source'], row['run']) for row in csv.DictReader(results_file)
+                if not (retry_errors and row['error'])}
+
+
+def upgrade_results(results_path):
+    # A results file written with other columns (an earlier version) is rewritten with the current ones,
+    # so the rows appended next line up with its header
+    if not os.path.exists(results_path):
+        return
+    with open(results_path, newline='') as results_file:
+        reader = csv.DictReader(results_file)
+        rows = list(reader)
+    if reader.fieldnames == RESULT_COLUMNS:
+        return
+    with open(results_path + '.tmp', 'w', newline='') as results_file:
+        results_writer = csv.DictWriter(results_file, RESULT_COLUMNS, extrasaction='ignore')
+        results_writer.writeheader()
+        results_writer.writerows(rows)
+    os.replace(results_path + '.tmp', results_path)
+    if reader.fieldnames:
+        print(f"{results_path} rewritten with the current columns")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs='+', help="Directories, files or globs of csv exports and databases")
+    parser.add_argument("--manifest", default=MANIFEST)
+    parser.add_argument("--results", default=RESULTS)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--resamples", type=int, default=ut.BOOTSTRAP_RESAMPLES,
+                        help="Bootstrap resamples for the diffusivity interval, 0 to skip it")
+    parser.add_argument("--use-estimated-frequency", action="store_true",
+                        help="Analyze at the frequency estimated from the data instead of the configured one")
+    parser.add_argument("--cache", default=fc.CACHE_PATH, help="Fit cache file")
+    parser.add_argument("--no-cache", action="store_true", help="Analyze everything again, without the fit cache")
+    parser.add_argument("--retry-errors", action="store_true", help="Analyze again the files that failed last time")
+    args = parser.parse_args()
+
+    # The manifest and results file may sit in the directory being analyzed
+    skip = {os.path.abspath(path) for path in (args.manifest, args.results, args.cache)}
+    sources = [source for source in find_sources(args.inputs) if os.path.abspath(source) not in skip]
+    jobs = make_jobs(sources, read_manifest(args.manifest))
+    upgrade_results(args.results)
+    done = done_keys(args.results, args.retry_errors)
+    jobs = [{**job, 'resamples': args.resamples, 'use_estimated_frequency': args.use_estimated_frequency,
+             'cache': None if args.no_cache else args.cache}
+            for job in jobs if (job['source'], str(job['run'])) not in done]
+    print(f"{len(jobs)} to analyze, {len(done)} already in {args.results}")
+
+    new_file = not os.path.exists(args.results)
+    start_time = time.perf_counter()
+    with open(args.results, 'a', newline='') as results_file, ProcessPoolExecutor(args.workers) as pool:
+        results_writer = csv.DictWriter(results_file, RESULT_COLUMNS)
+        if new_file:
+            results_writer.writeheader()
+        futures = [pool.submit(analyze, job) for job in jobs]
+        for count, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results_writer.writerow(result)
+            results_file.flush()
+            print(f"[{count}/{len(jobs)}] {result['source']} {result['run']}: "
+                  f"{result.get('error') or result['diffusivity']} {result.get('warning') or ''}")
+
+    print(f"Done in {time.perf_counter() - start_time:.1f} s")
@@ -0,0 +1,68 @@
+# benchmarkFit.py
+# Times utils.fit_data with the closed-form linear fit against the curve_fit path on synthetic TC data
+# and checks both give the same fitted curve. --sliding times one-reading updates of slidingFit instead
+
+import argparse
+import time
+import numpy as np
+import utils as ut
+from slidingFit import SlidingSineFit
+
+SIZES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+SAMPLING_RATE = 1 / 0.01
+TEMP_FREQUENCY = 0.004  # Twice the OpAmp frequency
+NOISE = 0.05  # in C, standard deviation of the added noise
+REPEATS = 3  # Best of
+WINDOWS = [60, 600, 6000]  # in s, sliding fit windows
+UPDATES = 20000  # One-reading updates timed per sliding window
+
+
+def synthetic(n, sampling_rate=SAMPLING_RATE, frequency=TEMP_FREQUENCY, seed=0):
+    rng = np.random.default_rng(seed)
+    times = np.arange(n) / sampling_rate
+    temps = 0.5 + 2.0 * np.sin(2 * np.pi * frequency * (times + 37.0)) + rng.normal(0, NOISE, n)
+    return times, temps
+
+
+def best_time(method, temps, times, frequency, repeats=REPEATS):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = ut.fit_data(temps, times, frequency, method)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=SIZES)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--sliding", action="store_true", help="Time sliding fit updates for --windows instead")
+    parser.add_argument("--windows", type=float, nargs='+', default=WINDOWS)
+    args = parser.parse_args()
+
+    if args.sliding:
+        # Each update adds one reading, drops the expired one and reads out the fit
+        print(f"{'window s':>9} {'readings':>9} {'updates/s':>10}")
+        for window in args.windows:
+            size = int(window * SAMPLING_RATE)
+            times, temps = synthetic(2 * size + UPDATES)
+            fitter = SlidingSineFit(TEMP_FREQUENCY, window)
+            fitter.add(times[:2 * size], temps[:2 * size])
+            start = time.perf_counter()
+            for i in range(2 * size, 2 * size + UPDATES):
+                fitter.add(times[i:i + 1], temps[i:i + 1])
+                fitter.result()
+            print(f"{window:>9.0f} {fitter.n:>9} {UPDATES / (time.perf_counter() - start):>10.0f}")
+    else:
+        print(f"{'readings':>10} {'curve_fit s':>12} {'linear s':>10} {'speedup':>8} {'max fit diff':>13} {'R^2 diff':>9}")
+        for n in args.sizes:
+            times, temps = synthetic(n)
+            curve_time, (curve_params, curve_r2) = best_time('curve_fit', temps, times, TEMP_FREQUENCY, args.repeats)
+            linear_time, (linear_params, linear_r2) = best_time('linear', temps, times, TEMP_FREQUENCY, args.repeats)
+
+            # Parameters can differ by a period or a sign flip, compare the fitted curves instead
+            curve_line = ut.sinusoidal_model(times, *curve_params, TEMP_FREQUENCY)
+            linear_line = ut.sinusoidal_model(times, *linear_params, TEMP_FREQUENCY)
+            print(f"{n:>10} {curve_time:>12.4f} {linear_time:>10.4f} {curve_time / linear_time:>7.1f}x "
+                  f"{np.max(np.abs(curve_line - linear_line)):>13.2e} {abs(curve_r2 - linear_r2):>9.1e}")
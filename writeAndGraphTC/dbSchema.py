@@ -0,0 +1,233 @@
+# dbSchema.py
+# Table layout shared by the writers, the dashboard and the tools
+# Every experiment is a row in runs, every reading is its own row keyed on (run_id, channel, relTime),
+# so there is no NULL padding for the slow channels and "latest window" / "latest value" of a channel in
+# a run are index range reads that cost the same however long the run is and however many runs are stored
+
+RUN_TABLE = "runs"
+SAMPLE_TABLE = "samples"
+POWER_TABLE = "power"
+RESULT_TABLE = "results"
+TC_CHANNELS = range(1, 9)  # TC-08 thermocouple channels, stored as channel 1-8
+
+# Experiment settings recorded with each run when not given on the command line
+OPAMP_FREQUENCY = .002  # 1/OpAmp Period, .002 for csv
+L = .72  # Distance between thermocouples
+POSITIONS = None  # Distance of TC1, TC2, ... from the heater, None for TC1 at 0 and TC2 at L (L is TC1 to TC2 if given)
+DENSITY = 1
+SPECIFIC_HEAT = 1
+TC_TIME_SHIFT = .68  # in s, TC2 lag behind TC1 when a row of channels shares one time (poll mode, csv), 0 deskewed
+
+CREATE_RUNS = f'''CREATE TABLE IF NOT EXISTS {RUN_TABLE} (
+                 run_id INTEGER PRIMARY KEY,
+                 start_time TEXT DEFAULT CURRENT_TIMESTAMP,
+                 opamp_frequency REAL,
+                 L REAL,
+                 density REAL,
+                 specific_heat REAL,
+                 sampling_rate REAL,
+                 note TEXT,
+                 positions TEXT,
+                 steady_time REAL,
+                 tc_shift REAL)'''
+
+# Columns added to runs since it was first laid out, added to older databases by create_tables
+ADDED_RUN_COLUMNS = {'positions': 'TEXT', 'steady_time': 'REAL', 'tc_shift': 'REAL'}
+
+CREATE_SAMPLES = f'''CREATE TABLE IF NOT EXISTS {SAMPLE_TABLE} (
+                    run_id INTEGER NOT NULL,
+                    channel INTEGER NOT NULL,
+                    relTime REAL NOT NULL,
+                    temp REAL NOT NULL,
+                    PRIMARY KEY (run_id, channel, relTime)) WITHOUT ROWID'''
+
+CREATE_POWER = f'''CREATE TABLE IF NOT EXISTS {POWER_TABLE} (
+                  run_id INTEGER NOT NULL,
+                  relTime REAL NOT NULL,
+                  power REAL NOT NULL,
+                  PRIMARY KEY (run_id, relTime)) WITHOUT ROWID'''
+
+# Fits of TC1 and TC2 over the window ending at relTime, every step of the run (see timeline)
+CREATE_RESULTS = f'''CREATE TABLE IF NOT EXISTS {RESULT_TABLE} (
+                    run_id INTEGER NOT NULL,
+                    relTime REAL NOT NULL,
+                    window_seconds REAL,
+                    amplitude1 REAL,
+                    phase1 REAL,
+                    amplitude2 REAL,
+                    phase2 REAL,
+                    r2_1 REAL,
+                    r2_2 REAL,
+                    delta_time REAL,
+                    amplitude_ratio REAL,
+                    diffusivity REAL,
+                    conductivity REAL,
+                    PRIMARY KEY (run_id, relTime)) WITHOUT ROWID'''
+RESULT_COLUMNS = ['relTime', 'window_seconds', 'amplitude1', 'phase1', 'amplitude2', 'phase2', 'r2_1', 'r2_2',
+                  'delta_time', 'amplitude_ratio', 'diffusivity', 'conductivity']
+
+INSERT_SAMPLE = f"INSERT OR REPLACE INTO {SAMPLE_TABLE} (run_id, channel, relTime, temp) VALUES (?, ?, ?, ?)"
+INSERT_POWER = f"INSERT OR REPLACE INTO {POWER_TABLE} (run_id, relTime, power) VALUES (?, ?, ?)"
+INSERT_RESULT = (f"INSERT OR REPLACE INTO {RESULT_TABLE} (run_id, {', '.join(RESULT_COLUMNS)}) "
+                 f"VALUES ({', '.join('?' * (len(RESULT_COLUMNS) + 1))})")
+UPDATE_SAMPLING_RATE = f"UPDATE {RUN_TABLE} SET sampling_rate = ? WHERE run_id = ?"
+UPDATE_STEADY_TIME = f"UPDATE {RUN_TABLE} SET steady_time = ? WHERE run_id = ?"  # relTime the transient ends (steadyState)
+
+
+def create_tables(conn):
+    conn.execute(CREATE_RUNS)
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({RUN_TABLE})")]
+    for column, column_type in ADDED_RUN_COLUMNS.items():
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {RUN_TABLE} ADD COLUMN {column} {column_type}")
+    conn.execute(CREATE_SAMPLES)
+    conn.execute(CREATE_POWER)
+    conn.execute(CREATE_RESULTS)
+    conn.commit()
+
+
+def create_run(conn, opamp_frequency=OPAMP_FREQUENCY, L=L, density=DENSITY, specific_heat=SPECIFIC_HEAT,
+               sampling_rate=None, note=None, positions=POSITIONS, tc_shift=TC_TIME_SHIFT):
+    if positions:
+        if len(positions) < 2:
+            raise ValueError("Give the positions of TC1 and TC2 at least")
+        L = abs(positions[1] - positions[0])  # The run's L is the distance between its main pair, see main_pair
+    positions = " ".join(str(position) for position in positions) if positions else None
+    cursor = conn.execute(f'''INSERT INTO {RUN_TABLE} (opamp_frequency, L, density, specific_heat, sampling_rate, note,
+                                                     positions, tc_shift)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                          (opamp_frequency, L, density, specific_heat, sampling_rate, note, positions, tc_shift))
+    conn.commit()
+    return cursor.lastrowid
+
+
+def add_run_arguments(parser):
+    # Command line options for the settings of a new run, used by the writers
+    parser.add_argument("--frequency", type=float, default=OPAMP_FREQUENCY, help="OpAmp frequency of the run")
+    parser.add_argument("--L", type=float, default=L, help="Distance between thermocouples")
+    parser.add_argument("--density", type=float, default=DENSITY)
+    parser.add_argument("--specific-heat", type=float, default=SPECIFIC_HEAT)
+    parser.add_argument("--note", default=None, help="Free text saved with the run")
+    parser.add_argument("--positions", type=float, nargs='+', default=POSITIONS,
+                        help="Distance of TC1, TC2, ... from the heater, for the all-pairs analysis (sets L)")
+
+
+def create_run_from_args(conn, args, sampling_rate=None, tc_shift=TC_TIME_SHIFT):
+    return create_run(conn, args.frequency, args.L, args.density, args.specific_heat, sampling_rate, args.note,
+                      args.positions, tc_shift)
+
+
+def run_positions(run):
+    # {channel: distance from the heater} of a run, TC1 at 0 and TC2 at L when no positions were recorded
+    if run.get('positions'):
+        return {channel: float(position) for channel, position in zip(TC_CHANNELS, run['positions'].split())}
+    return {1: 0.0, 2: run['L']}
+
+
+def main_pair(run):
+    # (near, far, L) of the pair the run's diffusivity comes from: TC1 and TC2, the one nearer the heater first,
+    # L the distance between them from the recorded positions, else the run's L
+    positions = run_positions(run)
+    near, far = sorted((1, 2), key=positions.get)
+    return near, far, positions[far] - positions[near]
+
+
+def run_tc_shift(run):
+    # TC2 lag behind TC1 the analyses subtract from TC2's times, TC_TIME_SHIFT for runs recorded before it was stored
+    return TC_TIME_SHIFT if run.get('tc_shift') is None else run['tc_shift']
+
+
+def get_run(cursor, run_id):
+    # Settings of a run as a dict, None if there is no such run
+    cursor.execute(f"SELECT * FROM {RUN_TABLE} WHERE run_id = ?", (run_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([description[0] for description in cursor.description], row))
+
+
+def latest_run_id(cursor):
+    cursor.execute(f"SELECT MAX(run_id) FROM {RUN_TABLE}")
+    return cursor.fetchone()[0]
+
+
+def list_runs(cursor):
+    cursor.execute(f"SELECT * FROM {RUN_TABLE} ORDER BY run_id")
+    return cursor.fetchall()
+
+
+def delete_run(conn, run_id):
+    with conn:
+        conn.execute(f"DELETE FROM {SAMPLE_TABLE} WHERE run_id = ?", (run_id,))
+        conn.execute(f"DELETE FROM {POWER_TABLE} WHERE run_id = ?", (run_id,))
+        conn.execute(f"DELETE FROM {RESULT_TABLE} WHERE run_id = ?", (run_id,))
+        conn.execute(f"DELETE FROM {RUN_TABLE} WHERE run_id = ?", (run_id,))
+
+
+def sample_rows(run_id, rel_time, temps, first_channel=1):
+    # Rows for INSERT_SAMPLE from one reading of consecutive channels, None readings are skipped
+    return [(run_id, channel, rel_time, temp) for channel, temp in enumerate(temps, first_channel)
+            if temp is not None]
+
+
+def latest_window(cursor, run_id, channel, limit):
+    # Newest `limit` readings of a channel, returned oldest first as (relTime, temp)
+    cursor.execute(f'''SELECT relTime, temp
+                      FROM {SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel = ?
+                      ORDER BY relTime DESC
+                      LIMIT ?''', (run_id, channel, limit))
+    return cursor.fetchall()[::-1]
+
+
+def readings_since(cursor, run_id, channel, after):
+    # Readings of a channel newer than relTime `after`, oldest first, a range scan of the primary key
+    cursor.execute(f'''SELECT relTime, temp
+                      FROM {SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel = ? AND relTime > ?
+                      ORDER BY relTime''', (run_id, channel, after))
+    return cursor.fetchall()
+
+
+def latest_value(cursor, run_id, channel):
+    # Newest (relTime, temp) of a channel, None if it has no readings
+    cursor.execute(f'''SELECT relTime, temp
+                      FROM {SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel = ?
+                      ORDER BY relTime DESC
+                      LIMIT 1''', (run_id, channel))
+    return cursor.fetchone()
+
+
+def first_value(cursor, run_id, channel):
+    # Oldest (relTime, temp) of a channel, None if it has no readings
+    cursor.execute(f'''SELECT relTime, temp
+                      FROM {SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel = ?
+                      ORDER BY relTime
+                      LIMIT 1''', (run_id, channel))
+    return cursor.fetchone()
+
+
+def readings_between(cursor, run_id, channel, start, end):
+    # Readings of a channel with start <= relTime <= end, oldest first
+    cursor.execute(f'''SELECT relTime, temp
+                      FROM {SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel = ? AND relTime BETWEEN ? AND ?
+                      ORDER BY relTime''', (run_id, channel, start, end))
+    return cursor.fetchall()
+
+
+def latest_result_time(cursor, run_id):
+    # relTime of the newest timeline result of a run, None if there are none
+    cursor.execute(f"SELECT MAX(relTime) FROM {RESULT_TABLE} WHERE run_id = ?", (run_id,))
+    return cursor.fetchone()[0]
+
+
+def results_since(cursor, run_id, after):
+    # Timeline results (RESULT_COLUMNS) of a run newer than relTime `after`, oldest first
+    cursor.execute(f'''SELECT {', '.join(RESULT_COLUMNS)}
+                      FROM {RESULT_TABLE}
+                      WHERE run_id = ? AND relTime > ?
+                      ORDER BY relTime''', (run_id, after))
+    return cursor.fetchall()
@@ -1,17 +1,37 @@
+# drop.py
+# Deletes one run from the database, or every table with --all
+# With no arguments the stored runs are listed
+
+import argparse
 import sqlite3
+import dbSchema as db
+
+parser = argparse.ArgumentParser()
+parser.add_argument("run", nargs="?", type=int, help="run_id to delete")
+parser.add_argument("--all", action="store_true", help="Drop every table in the database")
+parser.add_argument("--db", default='your_database.db')
+args = parser.parse_args()
 
-conn = sqlite3.connect('your_database.db')
+conn = sqlite3.connect(args.db)
 cursor = conn.cursor()
 
-# List all table names in the database
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-tables = cursor.fetchall()
+if args.all:
+    # List all table names in the database
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    tables = cursor.fetchall()
 
-# Drop each table
-for table in tables:
-    cursor.execute(f"DROP TABLE IF EXISTS {table[0]}")
+    # Drop each table
+    for table in tables:
+        cursor.execute(f"DROP TABLE IF EXISTS {table[0]}")
+    conn.commit()
+elif args.run is not None:
+    db.delete_run(conn, args.run)
+    print(f"Deleted run {args.run}")
+else:
+    db.create_tables(conn)
+    for run in db.list_runs(cursor):
+        print(run)
 
-# Commit and close
-conn.commit()
+# Close
 cursor.close()
 conn.close()
@@ -0,0 +1,119 @@
+# exportRun.py
+# Exports a run (or part of it) from the database to Parquet, Arrow IPC or CSV
+# Rows are streamed out of SQLite in fetchmany chunks, so memory stays the same however long the run is
+# Output has one row per reading: channel, relTime, temp (ordered by channel, then time)
+
+import argparse
+import csv
+import sqlite3
+import time
+import dbSchema as db
+
+DATABASE_NAME = 'your_database.db'
+CHUNK_SIZE = 100000  # Rows fetched and written at a time
+COMPRESSION = 'zstd'  # Parquet / Arrow compression codec
+COLUMNS = ['channel', 'relTime', 'temp']
+
+
+def fetch_chunks(cursor, run_id, channels=None, start=None, end=None, chunk_size=CHUNK_SIZE):
+    # Yield lists of (channel, relTime, temp) rows of the run, using the (run_id, channel, relTime) key
+    query = f"SELECT channel, relTime, temp FROM {db.SAMPLE_TABLE} WHERE run_id = ?"
+    params = [run_id]
+    if channels:
+        query += f" AND channel IN ({', '.join('?' * len(channels))})"
+        params += list(channels)
+    if start is not None:
+        query += " AND relTime >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND relTime <= ?"
+        params.append(end)
+    cursor.execute(query + " ORDER BY channel, relTime", params)
+
+    while 1:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def write_csv(chunks, path):
+    with open(path, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(COLUMNS)
+        for rows in chunks:
+            csv_writer.writerows(rows)
+            yield len(rows)
+
+
+def write_arrow(chunks, path, file_format, compression=COMPRESSION):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet and Arrow export need pyarrow, pip install pyarrow (or use --format csv)")
+
+    schema = pa.schema([('channel', pa.int16()), ('relTime', pa.float64()), ('temp', pa.float64())])
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(path, schema, compression=compression)
+    else:
+        writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    try:
+        for rows in chunks:
+            channel, rel_time, temp = zip(*rows)
+            writer.write_batch(pa.record_batch([pa.array(channel, pa.int16()), pa.array(rel_time, pa.float64()),
+                                                pa.array(temp, pa.float64())], schema=schema))
+            yield len(rows)
+    finally:
+        writer.close()
+
+
+def export(cursor, run_id, path, file_format='parquet', channels=None, start=None, end=None,
+           chunk_size=CHUNK_SIZE, compression=COMPRESSION):
+    chunks = fetch_chunks(cursor, run_id, channels, start, end, chunk_size)
+    if file_format == 'csv':
+        written = write_csv(chunks, path)
+    else:
+        written = write_arrow(chunks, path, file_format, compression)
+
+    # Report progress as chunks are written
+    start_time = time.perf_counter()
+    total = 0
+    for count in written:
+        total += count
+        elapsed = time.perf_counter() - start_time
+        print(f"{total} rows, {total / elapsed:.0f} rows/s")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", type=int, default=None, help="run_id to export, latest run by default")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--format", choices=['parquet', 'arrow', 'csv'], default='parquet')
+    parser.add_argument("--channels", type=int, nargs='+', default=None, help="Channels to export, all by default")
+    parser.add_argument("--start", type=float, default=None, help="First relTime to export")
+    parser.add_argument("--end", type=float, default=None, help="Last relTime to export")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--compression", default=COMPRESSION)
+    parser.add_argument("--out", default=None, help="Output file, run<id>.<format> by default")
+    args = parser.parse_args()
+
+    # Connect to the database, create a cursor
+    conn = sqlite3.connect(args.db)
+    cursor = conn.cursor()
+    run_id = args.run if args.run is not None else db.latest_run_id(cursor)
+    if run_id is None or db.get_run(cursor, run_id) is None:
+        raise SystemExit(f"No run {args.run if args.run is not None else ''} in {args.db}")
+    path = args.out or f"run{run_id}.{args.format}"
+
+    start_time = time.perf_counter()
+    total = export(cursor, run_id, path, args.format, args.channels, args.start, args.end, args.chunk,
+                   args.compression)
+    elapsed = time.perf_counter() - start_time
+    print(f"Exported {total} rows of run {run_id} to {path} in {elapsed:.1f} s ({total / max(elapsed, 1e-9):.0f} rows/s)")
+
+    # Close the cursor and the connection
+    cursor.close()
+    conn.close()
@@ -0,0 +1,111 @@
+# fitCache.py
+# Persistent cache of fit and diffusivity results so the same readings are not fit again by every dashboard
+# session, restart or batch rerun. Entries live in their own SQLite file, keyed on everything the result
+# depends on (run, window start/end, channels, frequency, preprocessing settings) and stored with a
+# fingerprint of the readings they came from: an entry whose readings have changed since is a miss.
+# The least recently used entries are dropped once the stored results pass MAX_BYTES, down to EVICT_TO of it
+# so eviction (which sorts the table) only runs now and then. The total size is kept in its own row.
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import dbSchema as db
+
+CACHE_PATH = 'fit_cache.db'
+MAX_BYTES = 50 * 2 ** 20  # Stored result size kept, least recently used entries are evicted past it
+EVICT_TO = 0.8  # Fraction of MAX_BYTES left after an eviction
+CACHE_VERSION = 1  # Part of every key, bump when a change to the analysis makes old results wrong
+
+CREATE_CACHE = '''CREATE TABLE IF NOT EXISTS fit_cache (
+                  key TEXT PRIMARY KEY,
+                  fingerprint TEXT NOT NULL,
+                  value TEXT NOT NULL,
+                  bytes INTEGER NOT NULL,
+                  last_used REAL NOT NULL)'''
+CREATE_SIZE = '''CREATE TABLE IF NOT EXISTS fit_cache_size (bytes INTEGER NOT NULL)'''
+
+
+def to_json(value):
+    # numpy scalars and arrays as plain floats and lists, so keys and values serialize the same every time
+    return json.dumps(value, sort_keys=True, separators=(',', ':'),
+                      default=lambda item: item.tolist() if isinstance(item, (np.ndarray, np.generic)) else str(item))
+
+
+def window_fingerprint(cursor, run_id, channels, start, end):
+    # Count, sums and time span of each channel's readings in [start, end], computed in SQLite.
+    # Any reading added, replaced or deleted in the window changes it
+    cursor.execute(f'''SELECT channel, COUNT(*), TOTAL(temp), TOTAL(temp * relTime), MIN(relTime), MAX(relTime)
+                      FROM {db.SAMPLE_TABLE}
+                      WHERE run_id = ? AND channel IN ({', '.join('?' * len(channels))}) AND relTime BETWEEN ? AND ?
+                      GROUP BY channel''', (run_id, *channels, start, end))
+    return to_json(cursor.fetchall())
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return to_json([stat.st_size, stat.st_mtime_ns])
+
+
+class FitCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        # Batch workers share the file, the dashboard uses it from its compute threads (one at a time)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(CREATE_CACHE)
+            self.conn.execute(CREATE_SIZE)
+            self.conn.execute('''INSERT INTO fit_cache_size SELECT (SELECT TOTAL(bytes) FROM fit_cache)
+                                 WHERE NOT EXISTS (SELECT 1 FROM fit_cache_size)''')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(key):
+        return hashlib.sha1(to_json({'version': CACHE_VERSION, **key}).encode()).hexdigest()
+
+    def get(self, key, fingerprint):
+        # Stored value of key (a dict) if it was computed from readings with this fingerprint, else None
+        key = self.make_key(key)
+        row = self.conn.execute("SELECT fingerprint, value FROM fit_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] != fingerprint:
+            self.misses += 1
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE fit_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, key, fingerprint, value):
+        key, value = self.make_key(key), to_json(value)
+        with self.conn:
+            # Size of the entry replaced (if any) out, the new one in
+            self.conn.execute('''UPDATE fit_cache_size SET bytes = bytes + ?
+                                     - (SELECT TOTAL(bytes) FROM fit_cache WHERE key = ?)''', (len(value), key))
+            self.conn.execute("INSERT OR REPLACE INTO fit_cache VALUES (?, ?, ?, ?, ?)",
+                              (key, fingerprint, value, len(value), time.time()))
+            if self.conn.execute("SELECT bytes FROM fit_cache_size").fetchone()[0] > self.max_bytes:
+                self._evict()
+
+    def cached(self, key, fingerprint, compute):
+        # get, or compute() and put
+        value = self.get(key, fingerprint)
+        if value is None:
+            value = compute()
+            self.put(key, fingerprint, value)
+            value = json.loads(to_json(value))  # The same types a hit returns
+        return value
+
+    def _evict(self):
+        # Least recently used first, until the rest fit in EVICT_TO of the budget
+        self.conn.execute('''DELETE FROM fit_cache WHERE key IN (
+                                 SELECT key FROM (SELECT key, SUM(bytes) OVER (ORDER BY last_used DESC) AS kept
+                                                  FROM fit_cache)
+                                 WHERE kept > ?)''', (self.max_bytes * EVICT_TO,))
+        self.conn.execute("UPDATE fit_cache_size SET bytes = (SELECT TOTAL(bytes) FROM fit_cache)")
+
+    def close(self):
+        self.conn.close()
@@ -1,39 +1,462 @@
 # graphAsBokeh.py
-# Queries the SQLite Database to graph the TC data for monitoring
+# Queries the SQLite Database (or the writer's ring buffer while a run is live) to graph the TC data for monitoring
 # Uses flask to embed the dashboard onto an example webpage
 
 
 from bokeh.embed import server_document
-from bokeh.plotting import figure, curdoc, output_file, save
-from bokeh.models import ColumnDataSource
-from bokeh.layouts import column, row, layout
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, Span
+from bokeh.layouts import column, row
 from bokeh.models.widgets import Button, Div
 import numpy as np
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 import utils as ut
-from flask import Flask, render_template
+import dbSchema as db
+from ringBuffer import RingBuffer, RING_BUFFER_PATH
+from slidingFit import SlidingSineFit
+from lockIn import LockIn
+import fitCache as fc
+import argparse
+from flask import Flask, render_template, request
 from bokeh.server.server import Server
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from functools import partial
 
 # Set by User
-DENSITY = 1
-SPECIFIC_HEAT = 1
-L = .72  # Distance between thermocouples
-OPAMP_FREQUENCY = .002  # 1/OpAmp Period, .002 for csv
+# Density, specific heat, L, the OpAmp frequency and the TC time shift are read from the run being graphed (dbSchema)
 UPDATE_WAIT = 1000  # in ms, time between updating plot
+RUN_ID = None  # Run to graph, None for the latest run. Can be set per page with ?run=
 
 # Constant
-TC_TIME_SHIFT = 0.68  # Time difference between TCs (.68)
-SAMPLING_RATE = 1 / 0.01  # 1/.01 for csv, 1/.2 for daq (can safely be inaccurate)
-PERIODS_TO_VIEW = 2.5  # Determines how many periods of the sine curve will be graphed
-MAX_GRAPH_BUFFER = int(PERIODS_TO_VIEW * (1 / OPAMP_FREQUENCY) * SAMPLING_RATE)
+PERIODS_TO_VIEW = 2.5  # Determines how many periods of the sine curve will be graphed (the window, in time)
+WAIT_FOR_STEADY = True  # Leave the diffusivity out until the run is at periodic steady state (see steadyState)
+BOOTSTRAP_RESAMPLES = 200  # Resamples for the diffusivity confidence interval, 0 to not show one (none for 'lockin')
+POINT_BUDGET = 2000  # Max points per trace sent to the browser (min/max of each time bucket), 0 to send every reading
+FIT_MODE = 'sliding'  # 'sliding' fit updated from new readings (drift fit with the sine), 'lockin' (see lockIn),
+# 'window' moving average detrend and refit of the whole window every update
+FREQUENCY_CHECK = True  # Estimate the frequency TC1 oscillates at over the window every update, warn if off the run's
+USE_ESTIMATED_FREQUENCY = False  # Fit at the estimated frequency instead of the run's ('window' mode)
 DATABASE_NAME = 'your_database.db'
-TABLE_NAME = "Data1"
+TIMELINE_SMOOTHING = 10  # Timeline estimates averaged for the convergence line (timeline results, see timeline)
+USE_RING_BUFFER = True  # Take the live window from the writer's ring buffer when it holds the run, SQLite otherwise
+FIT_CACHE = fc.CACHE_PATH  # Fit cache file shared by sessions and restarts (see fitCache), None to not cache
+COMPUTE_THREADS = 4  # Runs analyzed at the same time, off the IOLoop. Each run's ticks never overlap
 
 app = Flask(__name__)
 
 
+def open_ring(run_id):
+    # The writer's ring buffer if it holds this run, else None
+    if not USE_RING_BUFFER:
+        return None
+    try:
+        ring = RingBuffer.open(RING_BUFFER_PATH)
+    except (FileNotFoundError, ValueError):
+        return None
+    return ring if ring.run_id == run_id else None
+
+
+class LiveWindow:
+    """
+    The last window_seconds of the given channels (TC1 and TC2 by default) for one run, plus the latest
+    reading of TC3-8.
+
+    update() only reads what is newer than the last relTime (SQLite) or sequence number (ring buffer)
+    already seen, appends it and drops readings that have left the window. It returns the new readings
+    per channel so they can be streamed to the plots.
+    """
+
+    def __init__(self, cursor, ring, run_id, window_seconds, channels=(1, 2)):
+        self.cursor = cursor
+        self.ring = ring
+        self.run_id = run_id
+        self.window_seconds = window_seconds
+        self.channels = [channel for channel in channels if ring is None or channel < ring.n_columns]
+        self.times = {channel: np.empty(0) for channel in self.channels}
+        self.temps = {channel: np.empty(0) for channel in self.channels}
+        self.watermark = {channel: None for channel in self.channels}  # Last relTime read from SQLite
+        self.seq = 0  # Last ring buffer sequence number read
+        self.latest = [None] * 6  # (relTime, temp) of TC3-8
+
+    def update(self):
+        new = self._read_ring() if self.ring is not None else self._read_sqlite()
+        for channel, (times, temps) in new.items():
+            if not len(times):
+                continue
+            times = np.concatenate([self.times[channel], times])
+            temps = np.concatenate([self.temps[channel], temps])
+            first = np.searchsorted(times, times[-1] - self.window_seconds, side='left')
+            self.times[channel], self.temps[channel] = times[first:], temps[first:]
+        return new
+
+    def _read_sqlite(self):
+        new = {}
+        for channel in self.channels:
+            if self.watermark[channel] is None:
+                # First read, start one window before the newest reading
+                last = db.latest_value(self.cursor, self.run_id, channel)
+                if last is None:
+                    new[channel] = (np.empty(0), np.empty(0))
+                    continue
+                self.watermark[channel] = last[0] - self.window_seconds - 1e-9
+            rows = np.array(db.readings_since(self.cursor, self.run_id, channel, self.watermark[channel]),
+                            dtype=float).reshape(-1, 2)
+            if len(rows):
+                self.watermark[channel] = rows[-1, 0]
+            new[channel] = (rows[:, 0], rows[:, 1])
+        self.latest = [db.latest_value(self.cursor, self.run_id, channel) for channel in range(3, 9)]
+        return new
+
+    def _read_ring(self):
+        first = self.seq == 0
+        # The first read copies only the last window of what the ring holds
+        view, seq = self.ring.latest_seconds(self.window_seconds) if first else self.ring.since(self.seq)
+        behind = seq - self.seq > len(view)  # The ring no longer held every row since the last read
+        rows = np.array(view)
+        intact = self.ring.intact_rows(view, seq)
+        if intact < len(rows):
+            # The writer got to the oldest rows while they were copied, keep the ones it cannot have reached
+            rows = rows[len(rows) - intact:]
+            behind = True
+        self.seq = seq
+
+        new = {}
+        until = rows[0, 0] if len(rows) else np.inf
+        for channel in self.channels:
+            valid = ~np.isnan(rows[:, channel])
+            new[channel] = (rows[valid, 0], rows[valid, channel])
+            if behind and not first:
+                # Readings the ring lost (fell behind by more than it holds, after Stop and Start) come from SQLite
+                held = self.times[channel]
+                after = held[-1] if len(held) else until - self.window_seconds
+                missed = np.array(db.readings_since(self.cursor, self.run_id, channel, after),
+                                  dtype=float).reshape(-1, 2)
+                missed = missed[missed[:, 0] < until]
+                new[channel] = (np.r_[missed[:, 0], new[channel][0]], np.r_[missed[:, 1], new[channel][1]])
+        for i, channel in enumerate(range(3, min(9, self.ring.n_columns))):
+            valid = np.flatnonzero(~np.isnan(rows[:, channel]))
+            if len(valid):
+                self.latest[i] = (rows[valid[-1], 0], rows[valid[-1], channel])
+        return new
+
+
+def all_pairs_text(live, positions, times, opamp_frequency, shift):
+    # Fit every placed TC over the window (on TC1's times) in one solve, diffusivity of each pair and of the
+    # regression over all positions
+    channels = [channel for channel in positions if len(live.times.get(channel, ()))]
+    if len(channels) < 3:
+        return ""
+    temps = np.column_stack([np.interp(times, live.times[channel], live.temps[channel]) for channel in channels])
+    sampling_rate = (len(times) - 1) / (times[-1] - times[0])
+    params, _ = ut.fit_channels(ut.process_data(temps, sampling_rate, opamp_frequency), times, opamp_frequency)
+    params[:, 2] -= shift * (np.array(channels) - 1)  # TC k is read (k - 1) * shift after TC1
+    x = [positions[channel] for channel in channels]
+    regression = ut.position_regression(params, x, opamp_frequency)[0]
+    pairs = "<br>".join(f"TC{channels[i]}-TC{channels[j]}: {d:.4g}"
+                        for i, j, d in ut.pair_diffusivities(params, x, opamp_frequency))
+    return f"Regression over {len(channels)} TCs: {regression:.4g}<br>{pairs}"
+
+
+def session_run_id(doc, cursor):
+    # ?run= on the page, else RUN_ID, else the latest run
+    arguments = doc.session_context.request.arguments if doc.session_context else {}
+    if 'run' in arguments:
+        return int(arguments['run'][0])
+    if RUN_ID is not None:
+        return RUN_ID
+    return db.latest_run_id(cursor)
+
+
+class RunAnalysis:
+    """
+    Reads and analyzes one run once per tick for every session graphing it, however many there are.
+
+    tick() brings the live window, the fits and the timeline up to date and hands the new snapshot to each
+    subscribed session. A snapshot is a dict that is never changed after it is published (every tick makes
+    new arrays), so sessions only copy from it into their own document. Ticks are a periodic callback on
+    the server's IOLoop, running while at least one session is subscribed, and the last session to leave
+    closes the analysis. The query and fits run on the compute threads so a slow fit does not hold up any
+    page, a tick that comes while the last one is still computing is skipped rather than queued.
+    """
+
+    def __init__(self, run_id):
+        self.conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False)  # Used by one compute thread at a time
+        self.cursor = self.conn.cursor()
+        self.run_id = run_id
+        self.run = run = db.get_run(self.cursor, run_id)
+        self.density = run['density']
+        self.specific_heat = run['specific_heat']
+        self.near, self.far, self.L = db.main_pair(run)  # TC1 and TC2, nearer the heater first, and their distance
+        self.opamp_frequency = run['opamp_frequency']
+        self.shift = db.run_tc_shift(run)  # Time difference between TCs, 0 for writeFromDAQ stream mode (deskewed)
+        self.positions = db.run_positions(run)  # With more than two TCs placed, every pair and the regression show
+        self.steady_time = run['steady_time']  # Stored by the writer once the heating transient is over
+        self.live = LiveWindow(self.cursor, open_ring(run_id), run_id, PERIODS_TO_VIEW / self.opamp_frequency,
+                               sorted({1, 2} | set(self.positions)))
+        window_seconds = self.live.window_seconds
+        self.bucket_width = window_seconds / (POINT_BUDGET / 2) if POINT_BUDGET else None  # Two points per bucket
+        self.fitters = {channel: SlidingSineFit(self.opamp_frequency, window_seconds) for channel in (1, 2)}
+        self.lock_ins = {}  # Made on the first update, their window is a whole number of periods of readings
+        self.fit_cache = fc.FitCache(FIT_CACHE) if FIT_CACHE else None
+        self.timeline = (np.empty(0), np.empty(0), np.empty(0))  # Times, diffusivity and its moving average
+        self.frequency_text = ""
+        self.last_window = None  # (first, last) relTime of the last fit window
+        self.last_slow = None  # Its bootstrap interval and all-pairs text
+        self.slow_stored = False  # Whether those are in the fit cache
+
+        self.subscribers = []  # deliver(snapshot) of each session
+        self.snapshot = None  # Latest published
+        self.callback = None
+        self.future = None  # Analysis running on the compute threads
+        self.closed = False
+        self.skipped = 0  # Ticks skipped while it ran
+
+    def subscribe(self, deliver):
+        # deliver(snapshot) is called with each new snapshot, and with the latest one straight away
+        self.subscribers.append(deliver)
+        if self.snapshot is not None:
+            deliver(self.snapshot)
+        if self.callback is None:
+            self.callback = PeriodicCallback(self.tick, UPDATE_WAIT)
+            self.callback.start()
+
+    def unsubscribe(self, deliver):
+        if deliver in self.subscribers:
+            self.subscribers.remove(deliver)
+        if self.subscribers:
+            return
+        # Nobody is watching: stop ticking and let go of the connections, ring buffer and window, once the
+        # analysis running (if any) is done. The next session to graph the run gets a new one
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+        if analyses.get(self.run_id) is self:
+            del analyses[self.run_id]
+        if self.future is None:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+        if self.fit_cache is not None:
+            self.fit_cache.close()
+        self.live = self.snapshot = None
+
+    def tick(self):
+        # On the IOLoop: start analyze() on a compute thread, published back on the IOLoop when done
+        if self.future is not None:
+            self.skipped += 1
+            return
+        self.future = compute.submit(self.timed_analyze)
+        IOLoop.current().add_future(self.future, self.publish)
+
+    def timed_analyze(self):
+        start_time = time.perf_counter()
+        snapshot = self.analyze()
+        snapshot['compute_seconds'] = time.perf_counter() - start_time
+        return snapshot
+
+    def publish(self, future):
+        self.future = None
+        if not self.subscribers:
+            self.close()  # Every session left while it ran
+            return
+        snapshot = future.result()
+        snapshot['skipped'], self.skipped = self.skipped, 0
+        self.snapshot = snapshot
+        for deliver in list(self.subscribers):
+            deliver(self.snapshot)
+
+    def update_timeline(self):
+        times, diffusivity, average = self.timeline
+        rows = np.array(db.results_since(self.cursor, self.run_id, times[-1] if len(times) else -np.inf), dtype=float)
+        if not len(rows):
+            return
+        new_times = rows[:, db.RESULT_COLUMNS.index('relTime')]
+        new = rows[:, db.RESULT_COLUMNS.index('diffusivity')]
+        tail = diffusivity[-TIMELINE_SMOOTHING:]  # Last estimates, for the moving average of the new ones
+        values = np.r_[tail, new]
+        sums = np.r_[0, np.cumsum(np.nan_to_num(values))]
+        counts = np.r_[0, np.cumsum(~np.isnan(values))]
+        index = np.arange(len(tail), len(values)) + 1
+        low = np.maximum(index - TIMELINE_SMOOTHING, 0)
+        with np.errstate(invalid='ignore'):
+            new_average = (sums[index] - sums[low]) / (counts[index] - counts[low])
+        self.timeline = (np.r_[times, new_times], np.r_[diffusivity, new], np.r_[average, new_average])
+
+    def analyze(self):
+        # Only readings newer than the last tick are read
+        live, fitters, lock_ins = self.live, self.fitters, self.lock_ins
+        opamp_frequency, L, positions, shift = self.opamp_frequency, self.L, self.positions, self.shift
+        new = live.update()
+        for channel in (1, 2):
+            times, temps = new[channel]
+            if channel == 2:
+                times = times + shift
+            if FIT_MODE == 'sliding':
+                fitters[channel].add(times, temps)
+            elif FIT_MODE == 'lockin':
+                if channel not in lock_ins and len(times) > 1:
+                    rate = (len(times) - 1) / (times[-1] - times[0])
+                    lock_ins[channel] = LockIn.for_rate(opamp_frequency, rate, n_channels=1)
+                if channel in lock_ins:
+                    lock_ins[channel].update(times, temps)
+
+        if self.steady_time is None:
+            self.steady_time = db.get_run(self.cursor, self.run_id)['steady_time']
+        steady_time = self.steady_time
+        self.update_timeline()
+        snapshot = {'window': {channel: (live.times[channel], live.temps[channel]) for channel in (1, 2)},
+                    'latest': list(live.latest), 'steady_time': steady_time, 'timeline': self.timeline, 'fit': None}
+
+        # The fit needs both channels over the same readings, keep the newest they have in common
+        # and none from before steady state
+        n = min(len(live.times[1]), len(live.times[2]))
+        if steady_time is not None:
+            n = min(n, len(live.times[1]) - np.searchsorted(live.times[1], steady_time))
+        if n < 2:
+            snapshot['frequency'] = self.frequency_text
+            return snapshot
+        times1, temps1 = live.times[1][-n:], live.temps[1][-n:]
+        times2, temps2 = live.times[2][-n:], live.temps[2][-n:]
+        sampling_rate = (n - 1) / (times1[-1] - times1[0])
+
+        # Fix timing for temps2
+        times2 = times2 + shift
+
+        # The sliding fits and lock-ins are set up for the run's frequency, only 'window' mode can follow the estimate
+        fit_frequency = opamp_frequency
+        if FREQUENCY_CHECK and times1[-1] - times1[0] >= 2 / opamp_frequency:
+            estimated = ut.estimate_frequency(temps1, sampling_rate)
+            warning = ut.frequency_warning(opamp_frequency, estimated)
+            self.frequency_text = f"Frequency: {estimated:.4g} Hz" + (f"<br><b>{warning}</b>" if warning else "")
+            if USE_ESTIMATED_FREQUENCY and FIT_MODE == 'window':
+                fit_frequency = estimated
+        snapshot['frequency'] = self.frequency_text
+
+        if FIT_MODE == 'lockin':
+            # Amplitude and phase kept up to date by the lock-ins, plotted as read
+            if len(lock_ins) < 2 or not all(lock_in.ready for lock_in in lock_ins.values()):
+                return snapshot
+            params1, params2 = lock_ins[1].params()[0], lock_ins[2].params()[0]
+            adjusted_r_squared1 = adjusted_r_squared2 = np.nan
+            temps1_pr, temps2_pr = temps1, temps2
+        elif FIT_MODE == 'sliding':
+            # Fit kept up to date from the new readings, plotted with the fitted drift removed
+            if min(fitters[1].n, fitters[2].n) <= fitters[1].n_params + 1:
+                return snapshot
+            params1, adjusted_r_squared1 = fitters[1].result()
+            params2, adjusted_r_squared2 = fitters[2].result()
+            temps1_pr = temps1 - fitters[1].drift(times1)
+            temps2_pr = temps2 - fitters[2].drift(times2)
+        else:
+            # Data pre-processing for noise-reduction, signal smoothing, normalization by removing moving average
+            temps1_pr, temps2_pr = ut.process_data(np.column_stack((temps1, temps2)), sampling_rate, fit_frequency).T
+
+            params1, adjusted_r_squared1 = ut.fit_data(temps1_pr, times1, fit_frequency)
+            params2, adjusted_r_squared2 = ut.fit_data(temps2_pr, times2, fit_frequency)
+        # The diffusivity is from the TC nearer the heater to the further one
+        pair = {1: (params1, temps1_pr, times1), 2: (params2, temps2_pr, times2)}
+        (near_params, near_temps, near_times), (far_params, far_temps, far_times) = pair[self.near], pair[self.far]
+        _, _, diffusivity, conductivity = ut.calculate_diffusivities(near_params, far_params, fit_frequency, L,
+                                                                     self.density, self.specific_heat)
+
+        # Confidence interval from resampling the residuals of a linear fit of the plotted (detrended) readings,
+        # and the fit of every placed TC. They are the slow part of an update: kept for as long as the window stays
+        # where it is, and stored in the fit cache once it has stopped moving (a finished run) for the next server
+        # or analysis of the run, which looks there on its first update. While the run is recorded every window
+        # is new and nothing is stored
+        # The lock-ins have no detrended readings to resample, their diffusivity is shown without an interval
+        def slow_results():
+            interval = (ut.bootstrap_diffusivity(near_temps, near_times, far_temps, far_times, fit_frequency, L,
+                                                 BOOTSTRAP_RESAMPLES)[0]
+                        if BOOTSTRAP_RESAMPLES and FIT_MODE != 'lockin' else None)
+            pairs = all_pairs_text(live, positions, times1, fit_frequency, shift) if len(positions) > 2 else None
+            return {'interval': interval, 'pairs': pairs}
+
+        transient = WAIT_FOR_STEADY and steady_time is None
+        window = (times1[0], times1[-1])
+        still = window == self.last_window
+        finished = live.ring is None or live.ring.closed  # Nothing more to come, the window stays where it is
+        key = {'run': self.run_id, 'start': times1[0], 'end': times1[-1], 'frequency': fit_frequency, 'L': L,
+               'mode': FIT_MODE, 'shift': shift, 'resamples': BOOTSTRAP_RESAMPLES, 'positions': positions}
+        start, end = min(times1[0], times2[0] - shift), max(times1[-1], times2[-1] - shift)
+
+        def fingerprint():
+            return fc.window_fingerprint(self.cursor, self.run_id, sorted({1, 2} | set(positions)), start, end)
+
+        if transient:
+            slow, self.slow_stored = {'interval': None, 'pairs': None}, False
+        elif still and self.last_slow is not None:
+            slow = self.last_slow  # Same readings as the last update
+        else:
+            slow, self.slow_stored = None, False
+            if self.fit_cache is not None and (self.last_window is None or finished):
+                slow = self.fit_cache.get(key, fingerprint())
+                self.slow_stored = slow is not None
+            if slow is None:
+                slow = slow_results()
+        if self.fit_cache is not None and not transient and not self.slow_stored and (still or finished):
+            self.fit_cache.put(key, fingerprint(), slow)
+            self.slow_stored = True
+        self.last_window, self.last_slow = window, slow
+        interval = f"<br>95% CI {slow['interval'][0]:.4g} - {slow['interval'][1]:.4g}" if slow['interval'] else ""
+
+        a1, b1, c1 = params1
+        y_fitted1 = a1 + b1 * np.sin(2 * np.pi * fit_frequency * (times1 + c1))
+
+        a2, b2, c2 = params2
+        y_fitted2 = a2 + b2 * np.sin(2 * np.pi * fit_frequency * (times2 + c2))
+
+        # Data for both lines of the fitted plot, the fit above used every reading
+        data = {'times1': times1, 'times2': times2,
+                'temps1': np.asarray(temps1_pr), 'temps2': np.asarray(temps2_pr),
+                'temps1fit': y_fitted1, 'temps2fit': y_fitted2}
+        if POINT_BUDGET:
+            # Keep the min/max readings of either TC so both lines keep their shape
+            keep = np.union1d(ut.minmax_indices(times1, data['temps1'], self.bucket_width),
+                              ut.minmax_indices(times1, data['temps2'], self.bucket_width))
+            data = {key: value[keep] for key, value in data.items()}
+        snapshot['fit'] = {'data': data,
+                           'diffusivity': "Diffusivity: waiting for steady state" if transient
+                           else f"Diffusivity: {diffusivity}{interval}",
+                           'conductivity': "Conductivity: waiting for steady state" if transient
+                           else f"Conductivity: {conductivity}",
+                           'r2_1': f"TC1 R^2: {adjusted_r_squared1}",
+                           'r2_2': f"TC1 R^2: {adjusted_r_squared2}",
+                           'pairs': slow['pairs']}
+        return snapshot
+
+
+analyses = {}  # run_id: RunAnalysis shared by every session graphing that run
+compute = ThreadPoolExecutor(max_workers=COMPUTE_THREADS, thread_name_prefix='compute')
+
+
+def shared_analysis(run_id):
+    if run_id not in analyses:
+        analyses[run_id] = RunAnalysis(run_id)
+    return analyses[run_id]
+
+
 def modify_doc(doc):
+    # The run to graph. Sessions only look it up, reading and fitting it is left to the run's shared analysis
+    conn = sqlite3.connect(DATABASE_NAME)
+    db.create_tables(conn)
+    run_id = session_run_id(doc, conn.cursor())
+    run = db.get_run(conn.cursor(), run_id)
+    conn.close()
+    if run is None:
+        doc.add_root(Div(text=f"No run {run_id if run_id is not None else ''} in {DATABASE_NAME}"))
+        return
+    analysis = None  # The run's shared analysis while subscribed
+    window_seconds = PERIODS_TO_VIEW / run['opamp_frequency']
+    shift = db.run_tc_shift(run)
+    bucket_width = window_seconds / (POINT_BUDGET / 2) if POINT_BUDGET else None  # Two points per bucket
+    streamed_until = {1: -np.inf, 2: -np.inf}  # End of the last bucket sent to the As Recorded plot
+    timeline_until = -np.inf  # relTime of the last result streamed
+
     # Create plot for curve fit data
     source = ColumnDataSource(data={'times1': [], 'times2': [],
                                     'temps1': [], 'temps2': [],
@@ -46,20 +469,33 @@ def modify_doc(doc):
     plot.line('times2', 'temps2', source=source, line_color='red', legend_label='TC2')
     plot.line('times2', 'temps2fit', source=source, line_color='brown', legend_label='TC2FIT')
 
-    # Create plot for temp data as read
-    source2 = ColumnDataSource(data={'times1': [], 'times2': [],
-                                     'temps1': [], 'temps2': []})
+    # Create plot for temp data as read, one source per TC as they get new readings independently
+    source2 = {channel: ColumnDataSource(data={'times': [], 'temps': []}) for channel in (1, 2)}
     plot2 = figure(title='Live Plot As Recorded', width=400, height=400)
     plot2.toolbar.logo = None
     plot2.toolbar_location = None
-    plot2.line('times1', 'temps1', source=source2, line_color='blue', legend_label='TC1')
-    plot2.line('times2', 'temps2', source=source2, line_color='red', legend_label='TC2')
+    plot2.line('times', 'temps', source=source2[1], line_color='blue', legend_label='TC1')
+    plot2.line('times', 'temps', source=source2[2], line_color='red', legend_label='TC2')
+
+    # Diffusivity of every step of the run, read from the results timeline.py stores, with a moving average
+    timeline_source = ColumnDataSource(data={'times': [], 'diffusivity': [], 'average': []})
+    timeline_plot = figure(title='Diffusivity over the run', width=800, height=300, x_axis_label='Time (s)')
+    timeline_plot.toolbar.logo = None
+    timeline_plot.scatter('times', 'diffusivity', source=timeline_source, size=3, color='gray', legend_label='Window')
+    timeline_plot.line('times', 'average', source=timeline_source, line_color='black',
+                       legend_label=f'Average of {TIMELINE_SMOOTHING}')
+    steady_span = Span(location=0, dimension='height', line_color='green', line_dash='dashed', visible=False)
+    timeline_plot.add_layout(steady_span)
 
     # Create text to display Diffusivity, Conductivity, R^2 Values
     textD = Div(text="Diffusivity: ", width=150, height=50)
     textC = Div(text="Conductivity: ", width=150, height=50)
     textR1 = Div(text="TC1 R^2: ", width=150, height=50)
     textR2 = Div(text="TC2 R^2: ", width=150, height=50)
+    textPairs = Div(text="", width=300)
+    textSteady = Div(text="", width=150)
+    textFrequency = Div(text="", width=300)
+    textLatency = Div(text="", width=300)
     text3 = Div(text="TC3: ", width=150, height=50)
     text4 = Div(text="TC4: ", width=150, height=50)
     text5 = Div(text="TC5: ", width=150, height=50)
@@ -67,126 +503,79 @@ def modify_doc(doc):
     text7 = Div(text="TC7: ", width=150, height=50)
     text8 = Div(text="TC8: ", width=150, height=50)
 
-    # Connect to the database, create a cursor
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    callback = None
-
-    def update_data():
-        cursor.execute(f'''SELECT relTime, temp1, temp2
-                          FROM {TABLE_NAME}
-                          ORDER BY relTime DESC
-                          LIMIT ?''', (MAX_GRAPH_BUFFER,))
-
-        results = cursor.fetchall()
-
-        cursor.execute(f'''SELECT temp3, temp4, temp5, temp6, temp7, temp8
-                          FROM {TABLE_NAME}
-                          WHERE temp3 IS NOT NULL
-                          ORDER BY relTime DESC
-                          LIMIT 1''')
-
-        results2 = cursor.fetchall()
-
-        # Add data
-        times1 = [row[0] for row in results]
-        temps1 = [row[1] for row in results]
-        temps2 = [row[2] for row in results]
-
-        # Fix timing for temps2
-        times2 = [x+TC_TIME_SHIFT for x in times1]
-
-        # Data pre-processing for noise-reduction, signal smoothing, normalization by removing moving average
-        temps1_pr = ut.process_data(temps1, SAMPLING_RATE, OPAMP_FREQUENCY)
-        temps2_pr = ut.process_data(temps2, SAMPLING_RATE, OPAMP_FREQUENCY)
-
-        params1, adjusted_r_squared1 = ut.fit_data(temps1_pr, times1, OPAMP_FREQUENCY)
-        params2, adjusted_r_squared2 = ut.fit_data(temps2_pr, times2, OPAMP_FREQUENCY)
-        phaseShifts = [params1[2], params2[2]]
-
-        # Continue with the remaining calculations
-        M = 2 * params1[1]
-        N = 2 * params2[1]
-        period = 1 / OPAMP_FREQUENCY
-
-        if M < 0:
-            phaseShifts[0] = phaseShifts[0] + period / 2
-            M = -M
-
-        if N < 0:
-            phaseShifts[1] = phaseShifts[1] + period / 2
-            N = -N
-
-            # Reduce first phase shift to the very first multiple to the right of t=0
-        if phaseShifts[0] > 0:
-            while phaseShifts[0] > 0:
-                phaseShifts[0] = phaseShifts[0] - period
-        else:
-            while phaseShifts[0] < -period:
-                phaseShifts[0] = phaseShifts[0] + period
-
-        # Reduce 2nd phase shift to the very first multiple to the right of t=0
-        if phaseShifts[1] > 0:
-            while phaseShifts[1] > 0:
-                phaseShifts[1] = phaseShifts[1] - period
-        else:
-            while phaseShifts[1] < -period:
-                phaseShifts[1] = phaseShifts[1] + period
-
-        # Add a phase to ensure 2 is after 1 in time
-        if phaseShifts[1] > phaseShifts[0]:
-            phaseShifts[1] = phaseShifts[1] - period
-
-        phaseDifference = abs(phaseShifts[1] - phaseShifts[0])  # From wave mechanics -
-        # same frequency but different additive constants
-        # so the phase difference is just the difference of the individual phase shifts
-        phaseDifference = phaseDifference % period
-        delta_time = phaseDifference
-
-        diffusivity = L ** 2 / (2 * delta_time * np.log(M / N))
-        conductivity = diffusivity * DENSITY * SPECIFIC_HEAT
-
-        a1, b1, c1 = params1
-        y_fitted1 = a1 + b1 * np.sin(2 * np.pi * OPAMP_FREQUENCY * (times1 + c1))
-
-        a2, b2, c2 = params2
-        y_fitted2 = a2 + b2 * np.sin(2 * np.pi * OPAMP_FREQUENCY * (times2 + c2))
-
-        # Update the ColumnDataSource data for both lines
-        source.data = {'times1': times1, 'times2': times2,
-                       'temps1': temps1_pr, 'temps2': temps2_pr,
-                       'temps1fit': y_fitted1, 'temps2fit': y_fitted2}
-        source2.data = {'times1': times1, 'times2': times2,
-                        'temps1': temps1, 'temps2': temps2}
-        textD.text = f"Diffusivity: {diffusivity}"
-        textC.text = f"Conductivity: {conductivity}"
-        textR1.text = f"TC1 R^2: {adjusted_r_squared1}"
-        textR2.text = f"TC1 R^2: {adjusted_r_squared2}"
-        if results2:
-            text3.text = f"TC3: {results2[0][0]}"
-            text4.text = f"TC4: {results2[0][1]}"
-            text5.text = f"TC5: {results2[0][2]}"
-            text6.text = f"TC6: {results2[0][3]}"
-            text7.text = f"TC7: {results2[0][4]}"
-            text8.text = f"TC8: {results2[0][5]}"
+    def apply(snapshot):
+        nonlocal timeline_until
+        # Copy the shared snapshot into this session's plots, As Recorded and the timeline streaming on from
+        # what this session has already been sent
+        for channel in (1, 2):
+            window_times, window_temps = snapshot['window'][channel]
+            if not len(window_times):
+                continue
+            if POINT_BUDGET:
+                # Send the buckets completed since the last update, each reduced to its min and max
+                complete = np.floor(window_times[-1] / bucket_width) * bucket_width
+                first, last = np.searchsorted(window_times, [streamed_until[channel], complete])
+                times, temps = ut.minmax_decimate(window_times[first:last], window_temps[first:last], bucket_width)
+                streamed_until[channel] = max(streamed_until[channel], complete)
+                rollover = POINT_BUDGET + 2
+            else:
+                first = np.searchsorted(window_times, streamed_until[channel], side='right')
+                times, temps = window_times[first:], window_temps[first:]
+                streamed_until[channel] = window_times[-1]
+                rollover = len(window_times)
+            if len(times):
+                if channel == 2:
+                    times = times + shift
+                source2[channel].stream({'times': times, 'temps': temps}, rollover=rollover)
+        for text, channel, value in zip([text3, text4, text5, text6, text7, text8], range(3, 9), snapshot['latest']):
+            if value is not None:
+                text.text = f"TC{channel}: {value[1]}"
+
+        steady_time = snapshot['steady_time']
+        if steady_time is not None:
+            steady_span.location, steady_span.visible = steady_time, True
+        textSteady.text = (f"Steady state from {steady_time:.1f} s" if steady_time is not None
+                           else "Heating transient, not at steady state yet")
+        times, diffusivity, average = snapshot['timeline']
+        first = np.searchsorted(times, timeline_until, side='right')
+        if first < len(times):
+            timeline_source.stream({'times': times[first:], 'diffusivity': diffusivity[first:],
+                                    'average': average[first:]})
+            timeline_until = times[-1]
+        textFrequency.text = snapshot['frequency']
+        skipped = f", {snapshot['skipped']} updates skipped while computing" if snapshot['skipped'] else ""
+        textLatency.text = f"Update computed in {snapshot['compute_seconds']:.3f} s{skipped}"
+
+        fit = snapshot['fit']
+        if fit is None:
+            return
+        source.data = dict(fit['data'])
+        textD.text = fit['diffusivity']
+        textC.text = fit['conductivity']
+        textR1.text = fit['r2_1']
+        textR2.text = fit['r2_2']
+        if fit['pairs'] is not None:
+            textPairs.text = fit['pairs']
+
+    def deliver(snapshot):
+        # Called by the shared analysis, the document is changed on this session's next tick
+        doc.add_next_tick_callback(partial(apply, snapshot))
 
     # Function to start periodic updates
     def start_updates():
-        # Connect to the database, create a cursor
-        global cursor, conn, callback
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        # Add a periodic callback to update the plot
-        callback = curdoc().add_periodic_callback(update_data, UPDATE_WAIT)
+        nonlocal analysis
+        # Subscribe to the run's analysis, it carries on from the last reading shown
+        if analysis is None:
+            analysis = shared_analysis(run_id)
+            analysis.subscribe(deliver)
 
     # Function to stop periodic updates
     def stop_updates():
-        global cursor, conn, callback
-        # Close the cursor and the connection
-        cursor.close()
-        conn.close()
-        # Remove the periodic callback to stop updates
-        curdoc().remove_periodic_callback(callback)
+        nonlocal analysis
+        # Stop receiving the run's snapshots, the analysis is closed once no session is subscribed
+        if analysis is not None:
+            analysis.unsubscribe(deliver)
+            analysis = None
 
     # Create start and stop buttons
     start_button = Button(label='Start Updates', button_type='success')
@@ -194,15 +583,19 @@ def modify_doc(doc):
 
     stop_button = Button(label='Stop Updates', button_type='danger')
     stop_button.on_click(stop_updates)
+    doc.on_session_destroyed(lambda session_context: stop_updates())
 
-    doc.add_root(column(row(start_button, stop_button),
-                        row(plot, column(textD, textC, textR1, textR2)),
-                        row(plot2, column(text3, text4, text5, text6, text7, text8))))
+    doc.add_root(column(row(start_button, stop_button, Div(text=f"Run {run_id}, started {run['start_time']}")),
+                        row(plot, column(textLatency, textSteady, textFrequency, textD, textC, textR1, textR2,
+                                         textPairs)),
+                        row(plot2, column(text3, text4, text5, text6, text7, text8)),
+                        timeline_plot))
 
 
 @app.route('/', methods=['GET'])
 def bkapp_page():
-    script = server_document('http://localhost:5006/bkapp')
+    arguments = {'run': request.args['run']} if 'run' in request.args else None
+    script = server_document('http://localhost:5006/bkapp', arguments=arguments)
     return render_template("embed.html", script=script, template="Flask")
 
 
@@ -214,7 +607,16 @@ def bk_worker():
 
 
 from threading import Thread
-Thread(target=bk_worker).start()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", type=int, default=RUN_ID, help="run_id to graph, latest run by default")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--ring", default=RING_BUFFER_PATH, help="Ring buffer file the writer publishes to")
+    args = parser.parse_args()
+    RUN_ID = args.run
+    DATABASE_NAME = args.db
+    RING_BUFFER_PATH = args.ring
+
+    Thread(target=bk_worker).start()
     app.run(port=8000)
@@ -0,0 +1,193 @@
+# lockIn.py
+# Digital lock-in (sliding single-bin DFT) giving the amplitude and phase of every channel at the known frequency
+# The slope between consecutive readings is multiplied by exp(-i*w*t) and summed over the last whole number
+# of periods, which a mean or a linear drift add nothing to. Only the newest reading is added and the oldest
+# dropped, a few multiply-adds per channel per reading, all channels in one numpy update.
+# Run it to follow the live ring buffer (or a stored run with --run), printing amplitude, phase and the
+# TC1/TC2 diffusivity from the same calculation the dashboard uses (and the regression over all TCs when the
+# run has their positions).
+
+import argparse
+import sqlite3
+import time
+import numpy as np
+import utils as ut
+import dbSchema as db
+from ringBuffer import RingBuffer, RING_BUFFER_PATH
+
+PERIODS = 2  # Whole periods summed over
+RESUM_READINGS = 100000  # Readings between re-adding the window from scratch, bounds rounding drift
+REPORT_INTERVAL = 1  # in s, time between printing estimates
+DATABASE_NAME = 'your_database.db'
+
+
+class LockIn:
+    def __init__(self, frequency, window, n_channels=8, resum=RESUM_READINGS):
+        self.frequency = frequency
+        self.omega = 2 * np.pi * frequency
+        self.window = int(window)  # Readings summed over, a whole number of periods at the sampling rate
+        self.n_channels = n_channels
+        self.resum = resum
+
+        # Window of readings, zero in slots not written yet so dropping them takes nothing away
+        self.z = np.zeros((self.window, n_channels), dtype=complex)  # slope * exp(-i*w*t)
+        self.y = np.zeros((self.window, n_channels))  # temp
+        self.z_sum = np.zeros(n_channels, dtype=complex)
+        self.y_sum = np.zeros(n_channels)
+        self.count = 0  # Readings ever added
+        self.since_resum = 0
+        self.last_time = None  # Previous reading, the slope is taken between consecutive readings
+        self.last_temps = None
+
+    @classmethod
+    def for_rate(cls, frequency, sampling_rate, n_channels=8, periods=PERIODS):
+        return cls(frequency, round(periods * sampling_rate / frequency), n_channels)
+
+    @property
+    def ready(self):
+        # True once a full window has been summed
+        return self.count >= self.window
+
+    def update(self, times, temps):
+        # Add readings (times, and temps with one column per channel), returns the amplitude (b1) and
+        # phase (w * b2) of every channel after each reading
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        temps = np.asarray(temps, dtype=float).reshape(len(times), self.n_channels)
+        amplitude = np.empty(temps.shape)
+        phase = np.empty(temps.shape)
+        for start in range(0, len(times), self.window):
+            stop = min(start + self.window, len(times))
+            amplitude[start:stop], phase[start:stop] = self._update(times[start:stop], temps[start:stop])
+        return amplitude, phase
+
+    def _update(self, times, temps):
+        # At most one window of readings, so every slot written holds a reading leaving the window (or 0)
+        if self.last_time is None:
+            self.last_time, self.last_temps = times[0], temps[0]
+        times = np.r_[self.last_time, times]
+        temps = np.vstack([self.last_temps, temps])
+        missing = np.isnan(temps)
+        if missing.any():
+            # A missing reading repeats the channel's last one
+            last = np.where(missing, 0, np.arange(len(temps))[:, None])
+            temps = temps[np.maximum.accumulate(last, axis=0), np.arange(self.n_channels)]
+        self.last_time, self.last_temps = times[-1], temps[-1]
+
+        # Demodulate the slope between readings rather than the readings: a linear drift becomes a constant,
+        # which sums to zero over whole periods like the mean does. For b1*sin(wt + phase) the slope over dt is
+        # b1*w*cos(w*t_mid + phase) * sinc(w*dt/2) exactly
+        dt = np.diff(times)
+        gain = (dt * np.sinc(self.omega * dt / (2 * np.pi)))[:, None]
+        slopes = np.divide(np.diff(temps, axis=0), gain, out=np.zeros((len(dt), self.n_channels)), where=gain > 0)
+        z = slopes * np.exp(-1j * self.omega * (times[:-1] + dt / 2))[:, None]
+        z[np.isnan(z)] = 0  # Channels with no reading yet
+        temps = np.nan_to_num(temps[1:])
+
+        slots = (self.count + np.arange(len(dt))) % self.window
+        z_sums = self.z_sum + np.cumsum(z - self.z[slots], axis=0)
+        y_sums = self.y_sum + np.cumsum(temps - self.y[slots], axis=0)
+        self.z[slots] = z
+        self.y[slots] = temps
+        self.z_sum, self.y_sum = z_sums[-1], y_sums[-1]
+
+        filled = np.minimum(self.count + 1 + np.arange(len(dt)), self.window)[:, None]
+        self.count += len(dt)
+        self.since_resum += len(dt)
+        if self.since_resum >= self.resum:
+            self.z_sum = self.z.sum(axis=0)
+            self.y_sum = self.y.sum(axis=0)
+            self.since_resum = 0
+
+        # Mean of b1*w*cos(wt + phase) * exp(-iwt) over whole periods is b1*w/2 * exp(i*phase)
+        bins = z_sums / filled
+        return 2 * np.abs(bins) / self.omega, np.angle(bins)
+
+    def params(self):
+        # Latest [b0, b1, b2] of every channel, rows like utils.fit_data's popt
+        filled = max(1, min(self.count, self.window))
+        bins = self.z_sum / filled
+        return np.column_stack((self.y_sum / filled, 2 * np.abs(bins) / self.omega, np.angle(bins) / self.omega))
+
+
+def report(lock_in, rel_time, positions, shift, pair):
+    params = lock_in.params()
+    params[:, 2] -= shift * np.arange(len(params))  # Phases on TC1's clock, TC k is read (k - 1) * shift after TC1
+    estimates = ", ".join(f"TC{channel + 1} {b1:.3f} @ {b2:.1f} s" for channel, (_, b1, b2) in enumerate(params))
+    diffusivity = np.nan
+    if lock_in.ready:
+        near, far, L = pair
+        diffusivity = ut.calculate_diffusivities(params[near - 1], params[far - 1], lock_in.frequency, L)[2]
+    line = f"{rel_time:.1f} s: amplitude @ phase shift {estimates}, diffusivity {diffusivity}"
+
+    # Regression over every placed TC when the run has their positions
+    placed = [channel for channel in positions if channel <= lock_in.n_channels]
+    if lock_in.ready and len(placed) > 2:
+        regression = ut.position_regression(params[np.array(placed) - 1], [positions[channel] for channel in placed],
+                                            lock_in.frequency)[0]
+        line += f", regression over {len(placed)} TCs {regression}"
+    print(line)
+
+
+def load_run(cursor, run_id, n_channels):
+    # Every channel of a stored run on TC1's times (NaN where a channel has no readings)
+    times, temps1 = np.array(db.readings_since(cursor, run_id, 1, -np.inf), dtype=float).reshape(-1, 2).T
+    temps = np.full((len(times), n_channels), np.nan)
+    temps[:, 0] = temps1
+    for channel in range(2, n_channels + 1):
+        rows = np.array(db.readings_since(cursor, run_id, channel, -np.inf), dtype=float).reshape(-1, 2)
+        if len(rows):
+            temps[:, channel - 1] = np.interp(times, rows[:, 0], rows[:, 1], left=np.nan, right=np.nan)
+    return times, temps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", type=int, default=None, help="Analyze a stored run instead of following the ring buffer")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--ring", default=RING_BUFFER_PATH)
+    parser.add_argument("--periods", type=int, default=PERIODS, help="Whole periods summed over")
+    parser.add_argument("--sampling-rate", type=float, default=None, help="Overrides the run's sampling rate")
+    parser.add_argument("--shift", type=float, default=None,
+                        help="Time difference between TC1 and TC2, the run's by default")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    cursor = conn.cursor()
+    ring = None if args.run is not None else RingBuffer.open(args.ring)
+    run = db.get_run(cursor, args.run if ring is None else ring.run_id)
+    if run is None:
+        raise SystemExit(f"No run {args.run if ring is None else ring.run_id} in {args.db}")
+    sampling_rate = args.sampling_rate or run['sampling_rate']
+    if not sampling_rate:
+        raise SystemExit("The run has no sampling rate, give --sampling-rate")
+    n_channels = len(db.TC_CHANNELS) if ring is None else ring.n_columns - 1
+    positions = db.run_positions(run)
+    shift = db.run_tc_shift(run) if args.shift is None else args.shift
+    pair = db.main_pair(run)
+    lock_in = LockIn.for_rate(run['opamp_frequency'], sampling_rate, n_channels, args.periods)
+
+    if ring is None:
+        # Stored run, one report per period of data
+        times, temps = load_run(cursor, run['run_id'], n_channels)
+        step = max(1, round(sampling_rate / run['opamp_frequency']))
+        for start in range(0, len(times), step):
+            lock_in.update(times[start:start + step], temps[start:start + step])
+            report(lock_in, times[min(start + step, len(times)) - 1], positions, shift, pair)
+    else:
+        # Live, follow the ring buffer until the writer closes it
+        seq = 0
+        while 1:
+            closed = ring.closed
+            view, seq_now = ring.since(seq)
+            if len(view):
+                rows = np.array(view)
+                if ring.intact(view, seq_now):
+                    lock_in.update(rows[:, 0], rows[:, 1:])
+                    report(lock_in, rows[-1, 0], positions, shift, pair)
+            seq = seq_now
+            if closed:
+                break
+            time.sleep(REPORT_INTERVAL)
+
+    cursor.close()
+    conn.close()
@@ -0,0 +1,63 @@
+# migrateData1.py
+# Converts a database written with the old wide Data1 table (temp1..temp8, power, NULL padded)
+# into a new run in the per-channel samples / power tables of dbSchema
+
+import argparse
+import sqlite3
+import time
+import dbSchema as db
+
+DATABASE_NAME = 'your_database.db'
+TABLE_NAME = "Data1"
+CHUNK_SIZE = 50000  # Old rows converted per transaction
+
+
+def migrate(conn, run_id, table_name=TABLE_NAME, chunk_size=CHUNK_SIZE):
+    read_cursor = conn.cursor()
+    read_cursor.execute(f'''SELECT relTime, temp1, temp2, temp3, temp4, temp5, temp6, temp7, temp8, power
+                           FROM {table_name}
+                           ORDER BY rowid''')
+
+    migrated = 0
+    while 1:
+        rows = read_cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        samples = [sample for row in rows for sample in db.sample_rows(run_id, row[0], row[1:9])]
+        powers = [(run_id, row[0], row[9]) for row in rows if row[9] is not None]
+        with conn:
+            conn.executemany(db.INSERT_SAMPLE, samples)
+            conn.executemany(db.INSERT_POWER, powers)
+
+        migrated += len(rows)
+        print(f"Migrated {migrated} rows")
+
+    read_cursor.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--table", default=TABLE_NAME)
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--drop", action="store_true", help="Drop the old table once converted")
+    parser.add_argument("--sampling-rate", type=float, default=None, help="Sampling rate the old run was recorded at")
+    db.add_run_arguments(parser)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    start_time = time.time()
+    db.create_tables(conn)
+    run_id = db.create_run_from_args(conn, args, args.sampling_rate)
+    migrate(conn, run_id, args.table, args.chunk)
+    print(f"{args.table} is now run {run_id}")
+
+    if args.drop:
+        conn.execute(f"DROP TABLE IF EXISTS {args.table}")
+        conn.commit()
+        conn.execute("VACUUM")
+
+    print(f"Done in {time.time() - start_time:.1f} s")
+    conn.close()
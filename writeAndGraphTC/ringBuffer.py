@@ -0,0 +1,135 @@
+# ringBuffer.py
+# Fixed-capacity, memory-mapped ring of the newest samples shared between the writer and the dashboard
+# The writer appends rows of (relTime, temp1..tempN), NaN where a channel has no reading at that time.
+# Readers map the same file read-only and get the live window as a view, SQLite stays the durable store.
+#
+# Every row is written twice, at slot and slot + capacity, so the newest n <= capacity rows are always
+# one contiguous slice and can be handed out without copying. The sequence counter in the header counts
+# rows ever appended and is written after the rows it covers. As in a seqlock, the writer also publishes the
+# sequence number it is writing up to before it touches any row, so a reader that checks it after copying
+# knows which of the copied rows an append in progress may have overwritten.
+
+import bisect
+import os
+import tempfile
+import threading
+import numpy as np
+
+RING_BUFFER_PATH = os.path.join(tempfile.gettempdir(), 'tc_ring_buffer.dat')
+CAPACITY = 2 ** 19  # Rows kept, ~1.5 h at 100 Hz
+N_CHANNELS = 8
+
+# Header, int64 words in front of the data
+MAGIC = 0x7463726e67  # "tcrng"
+HEADER_WORDS = 8
+H_MAGIC, H_CAPACITY, H_COLUMNS, H_SEQ, H_RUN_ID, H_CLOSED, H_WRITING = range(7)
+
+
+class RingBuffer:
+    def __init__(self, path, mode):
+        header = np.memmap(path, dtype=np.int64, mode=mode, shape=(HEADER_WORDS,))
+        if header[H_MAGIC] != MAGIC:
+            raise ValueError(f"{path} is not a ring buffer")
+        self.path = path
+        self.capacity = int(header[H_CAPACITY])
+        self.n_columns = int(header[H_COLUMNS])
+        self.header = header
+        self._append_lock = threading.Lock()  # Several acquisition threads may append to one ring
+        self.data = np.memmap(path, dtype=np.float64, mode=mode, offset=HEADER_WORDS * 8,
+                              shape=(2 * self.capacity, self.n_columns))
+
+    @classmethod
+    def create(cls, path=RING_BUFFER_PATH, capacity=CAPACITY, n_channels=N_CHANNELS, run_id=0):
+        # Build the new file next to the old one and swap it in, readers of the old file see it closed
+        tmp_path = path + '.new'
+        header = np.memmap(tmp_path, dtype=np.int64, mode='w+',
+                           shape=(HEADER_WORDS + 2 * capacity * (n_channels + 1),))
+        header[:HEADER_WORDS] = 0
+        header[H_CAPACITY] = capacity
+        header[H_COLUMNS] = n_channels + 1
+        header[H_RUN_ID] = run_id
+        header[H_MAGIC] = MAGIC
+        header.flush()
+        del header
+
+        if os.path.exists(path):
+            try:
+                cls.open_writer(path).close()
+            except ValueError:
+                pass
+        os.replace(tmp_path, path)
+        return cls(path, 'r+')
+
+    @classmethod
+    def open_writer(cls, path=RING_BUFFER_PATH):
+        return cls(path, 'r+')
+
+    @classmethod
+    def open(cls, path=RING_BUFFER_PATH):
+        # Read-only mapping for the dashboard and analysis processes
+        return cls(path, 'r')
+
+    @property
+    def seq(self):
+        return int(self.header[H_SEQ])
+
+    @property
+    def writing(self):
+        # Sequence number the append in progress writes up to, seq when there is none
+        return int(self.header[H_WRITING])
+
+    @property
+    def run_id(self):
+        return int(self.header[H_RUN_ID])
+
+    @property
+    def closed(self):
+        return bool(self.header[H_CLOSED])
+
+    def close(self):
+        # Tell readers no more rows will come
+        self.header[H_CLOSED] = 1
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.n_columns)
+        with self._append_lock:
+            seq = self.seq
+            # More rows than fit, only the newest capacity rows are kept
+            skipped = max(0, len(rows) - self.capacity)
+            slots = (seq + skipped + np.arange(len(rows) - skipped)) % self.capacity
+            self.header[H_WRITING] = seq + len(rows)
+            self.data[slots] = rows[skipped:]
+            self.data[slots + self.capacity] = rows[skipped:]
+            self.header[H_SEQ] = seq + len(rows)
+
+    def latest(self, n):
+        # View of the newest n rows, oldest first, and the sequence number it was taken at
+        seq = self.seq
+        return self._window(seq, n), seq
+
+    def latest_seconds(self, seconds):
+        # View of the newest rows less than seconds older (relTime) than the newest one, found by a binary
+        # search of the time column so only the rows of the window get read when it is copied
+        view, seq = self.latest(self.capacity)
+        if len(view):
+            view = view[bisect.bisect_left(view[:, 0], view[-1, 0] - seconds):]
+        return view, seq
+
+    def since(self, seq_from):
+        # View of the rows appended after seq_from (as many as the ring still holds)
+        seq = self.seq
+        return self._window(seq, seq - seq_from), seq
+
+    def _window(self, seq, n):
+        n = max(0, min(n, seq, self.capacity))
+        end = seq % self.capacity + self.capacity
+        return self.data[end - n:end]
+
+    def intact_rows(self, view, seq):
+        # How many of the newest rows of a view taken at seq no append has started overwriting yet.
+        # Call it after the view has been copied, the rows before those may be torn
+        return max(0, min(len(view), self.capacity - (self.writing - seq)))
+
+    def intact(self, view, seq):
+        # True if a view taken at seq was not overwritten while it was being used
+        return self.intact_rows(view, seq) == len(view)
@@ -0,0 +1,107 @@
+# sampleWriter.py
+# Background writer stage between the acquisition loop and the SQLite database
+# Samples are queued without blocking and group-committed by a separate thread
+
+import queue
+import sqlite3
+import threading
+import time
+from itertools import groupby
+
+QUEUE_SIZE = 100000  # Max samples waiting to be written, new samples are dropped (and counted) past this
+FLUSH_ROWS = 500  # Flush once this many samples are waiting
+FLUSH_INTERVAL = 250  # in ms, flush at least this often when samples are waiting
+SYNCHRONOUS = "NORMAL"  # SQLite synchronous level, OFF/NORMAL/FULL/EXTRA. NORMAL is safe with WAL
+
+
+def connect(database_name, synchronous=SYNCHRONOUS):
+    # Open a connection in WAL mode so readers (the dashboard) never block the writer
+    conn = sqlite3.connect(database_name)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    return conn
+
+
+class SampleWriter(threading.Thread):
+    """
+    Writes queued samples to the database from its own thread.
+
+    put() never blocks, rows are flushed with executemany in one transaction every
+    flush_rows samples or flush_interval ms, whichever comes first.
+    """
+
+    def __init__(self, database_name, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 queue_size=QUEUE_SIZE, synchronous=SYNCHRONOUS):
+        super().__init__(name="SampleWriter", daemon=True)
+        self.database_name = database_name
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval / 1000
+        self.synchronous = synchronous
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+
+        # Statistics, only written by the writer thread (dropped by the caller of put)
+        self.rows_written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def put(self, sql, row, block=False):
+        # Queue one row for the given INSERT statement, by default never waits on the writer
+        # block=True waits for room instead of dropping, for sources that can be slowed down (replays)
+        try:
+            self.queue.put((sql, row), block=block)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=None):
+        # Write everything still queued, then end the thread
+        self._stop_event.set()
+        self.join(timeout)
+
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(),
+                'rows_written': self.rows_written,
+                'flushes': self.flushes,
+                'dropped': self.dropped,
+                'last_flush_ms': self.last_flush_latency * 1000,
+                'max_flush_ms': self.max_flush_latency * 1000}
+
+    def run(self):
+        conn = connect(self.database_name, self.synchronous)
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                # Take whatever else is already waiting without blocking
+                while len(batch) < self.flush_rows:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.flush_rows or time.monotonic() >= deadline:
+                self._flush(conn, batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+        self._flush(conn, batch)
+        conn.close()
+
+    def _flush(self, conn, batch):
+        if not batch:
+            return
+        start = time.perf_counter()
+
+        # One transaction per flush, consecutive rows of the same statement go through one executemany
+        with conn:
+            for sql, rows in groupby(batch, key=lambda item: item[0]):
+                conn.executemany(sql, [row for _, row in rows])
+
+        latency = time.perf_counter() - start
+        self.rows_written += len(batch)
+        self.flushes += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
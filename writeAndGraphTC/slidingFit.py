@@ -0,0 +1,118 @@
+# slidingFit.py
+# Sliding-window least squares fit of b0 + b1*sin(2*pi*f*(t + b2)), plus a linear drift, for live data
+# Only the readings entering and leaving the window are touched on each update: the running sums of the
+# normal equations are kept, so the fit costs O(new + expired readings) and reading out amplitude, phase
+# and R^2 is a 4x4 solve however long the window is.
+# The sums are rebuilt from the window every REANCHOR_READINGS readings so adding and subtracting can't drift.
+
+import collections
+import numpy as np
+
+REANCHOR_READINGS = 100000  # Readings added between rebuilding the sums from the window
+
+
+class SlidingSineFit:
+    def __init__(self, frequency, window_seconds, trend=True, reanchor=REANCHOR_READINGS):
+        self.frequency = frequency
+        self.omega = 2 * np.pi * frequency
+        self.window_seconds = window_seconds
+        self.trend = trend  # Fit a linear drift along with the sine (what the moving average removes otherwise)
+        self.reanchor = reanchor
+        self.chunks = collections.deque()  # (times, temps) arrays in the window, oldest first
+        self.t0 = None  # Anchor, the drift is fit against t - t0 and the sums are of temp - y0
+        self.y0 = 0.0
+        self._reset_sums()
+
+    @property
+    def n_params(self):
+        return 4 if self.trend else 3
+
+    def _reset_sums(self):
+        self.n = 0
+        self.G = np.zeros((self.n_params, self.n_params))  # sum of x x^T, x = (1, t - t0, sin wt, cos wt)
+        self.h = np.zeros(self.n_params)  # sum of x * (temp - y0)
+        self.q = 0.0  # sum of (temp - y0)^2
+        self.added = 0
+
+    def _features(self, times):
+        columns = [np.ones_like(times)]
+        if self.trend:
+            columns.append(times - self.t0)
+        columns += [np.sin(self.omega * times), np.cos(self.omega * times)]
+        return np.column_stack(columns)
+
+    def _accumulate(self, times, temps, sign):
+        X = self._features(times)
+        y = temps - self.y0
+        self.G += sign * (X.T @ X)
+        self.h += sign * (X.T @ y)
+        self.q += sign * (y @ y)
+        self.n += sign * len(times)
+
+    def add(self, times, temps):
+        # Add new readings (in time order) and drop the ones now older than the window
+        times = np.asarray(times, dtype=float)
+        temps = np.asarray(temps, dtype=float)
+        if not len(times):
+            return
+        if self.t0 is None:
+            self.t0 = times[0]
+            self.y0 = temps[0]
+
+        self.chunks.append((times, temps))
+        self._accumulate(times, temps, 1)
+        self._expire(times[-1] - self.window_seconds)
+
+        self.added += len(times)
+        if self.added >= self.reanchor:
+            self.rebuild()
+
+    def _expire(self, oldest):
+        # Subtract readings before `oldest`, same window as LiveWindow (relTime >= newest - window_seconds)
+        while self.chunks:
+            times, temps = self.chunks[0]
+            cut = np.searchsorted(times, oldest, side='left')
+            if cut == 0:
+                break
+            self._accumulate(times[:cut], temps[:cut], -1)
+            if cut < len(times):
+                self.chunks[0] = (times[cut:], temps[cut:])
+                break
+            self.chunks.popleft()
+
+    def rebuild(self):
+        # Recompute the sums from the readings in the window, anchored at its first reading and mean
+        if not self.chunks:
+            self._reset_sums()
+            return
+        times = np.concatenate([chunk[0] for chunk in self.chunks])
+        temps = np.concatenate([chunk[1] for chunk in self.chunks])
+        self.chunks = collections.deque([(times, temps)])
+        self.t0 = times[0]
+        self.y0 = np.mean(temps)
+        self._reset_sums()
+        self._accumulate(times, temps, 1)
+
+    def solve(self):
+        # Least squares coefficients of x = (1, [t - t0,] sin wt, cos wt) for temp - y0
+        if self.n <= self.n_params + 1:
+            raise ValueError(f"Sliding fit needs more than {self.n_params + 1} readings, has {self.n}")
+        return np.linalg.solve(self.G, self.h)
+
+    def result(self):
+        # Same contract as utils.fit_data: [b0, b1, b2] and the adjusted R squared of the fit over the window
+        beta = self.solve()
+        B, C = beta[-2:]
+        popt = np.array([self.y0 + beta[0], np.hypot(B, C), np.arctan2(C, B) / self.omega])
+
+        ss_res = self.q - beta @ self.h  # Residual sum of squares at the least squares solution
+        ss_tot = self.q - self.h[0] ** 2 / self.n
+        r_squared = 1 - ss_res / ss_tot
+        adjusted_r_squared = 1 - (1 - r_squared) * ((self.n - 1) / (self.n - self.n_params - 1))
+        return popt, adjusted_r_squared
+
+    def drift(self, times):
+        # Fitted linear drift at the given times (0 at t0), so temps - drift(times) is b0 + sine + noise
+        if not self.trend:
+            return np.zeros_like(np.asarray(times, dtype=float))
+        return self.solve()[1] * (np.asarray(times, dtype=float) - self.t0)
@@ -0,0 +1,158 @@
+# steadyState.py
+# Detects when a run has settled into periodic steady state after the heating transient
+# Readings are summed per whole period of the temperature wave (mean and the single DFT bin at the known
+# frequency), so each reading costs a few multiply-adds. When a period ends its mean, amplitude and phase are
+# compared with the period before. Once every watched channel has held still for STEADY_PERIODS periods in a
+# row the run is steady from the first of them, and stays so.
+# The writers feed it the readings they publish and store that time with the run (runs.steady_time), the
+# dashboard and batchAnalysis leave out the readings before it.
+# Run it to find (and store) the steady state time of a run recorded before the detector existed.
+
+import argparse
+import sqlite3
+import threading
+import numpy as np
+import dbSchema as db
+from lockIn import load_run
+
+STEADY_PERIODS = 3  # Consecutive periods that must all hold still
+MEAN_TOLERANCE = 0.05  # Largest change of the mean between periods, as a fraction of the amplitude
+AMPLITUDE_TOLERANCE = 0.02  # Largest relative change of the amplitude between periods
+PHASE_TOLERANCE = 0.05  # in rad, largest change of the phase between periods
+DATABASE_NAME = 'your_database.db'
+
+
+class SteadyStateDetector:
+    def __init__(self, frequency, channels=(1, 2), periods=STEADY_PERIODS, mean_tolerance=MEAN_TOLERANCE,
+                 amplitude_tolerance=AMPLITUDE_TOLERANCE, phase_tolerance=PHASE_TOLERANCE, on_steady=None):
+        self.frequency = frequency
+        self.omega = 2 * np.pi * frequency
+        self.channels = list(channels)  # Channels watched, column channel - 1 of the readings given to add
+        self.periods = periods
+        self.mean_tolerance = mean_tolerance
+        self.amplitude_tolerance = amplitude_tolerance
+        self.phase_tolerance = phase_tolerance
+        self.on_steady = on_steady  # Called with the steady state time once it is found
+        self.steady_time = None
+        self._lock = threading.Lock()  # Several acquisition threads may publish readings
+
+        # Sums of each period still open, per channel: readings, temp, exp(-iwt), temp * exp(-iwt).
+        # Every unit publishes its own channels from its own thread, so one channel can be a period ahead of
+        # another: a period is closed once every watched channel has readings from a later one
+        self.open = {}  # period index, floor(t * frequency): sums
+        self.newest = np.full(len(self.channels), -np.inf)  # Newest period each channel has readings in
+        self.first_period = None  # Period of the first reading, partly covered so never compared
+        self.closed = None  # Last period closed, later readings of it are too late to count
+        self.last = None  # (mean, amplitude, phase) of the last closed period
+        self.still = 0  # Consecutive periods that held still
+
+    def add(self, times, temps):
+        # Add readings, times and temps with a column per channel from channel 1 (ring buffer rows without
+        # the time column), NaN for no reading. Returns the steady state time, None while still settling
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        temps = np.asarray(temps, dtype=float).reshape(len(times), -1)
+        if self.steady_time is not None or not len(times):
+            return self.steady_time
+        columns = [channel - 1 for channel in self.channels]
+        watched = np.full((len(times), len(columns)), np.nan)
+        present = [i for i, column in enumerate(columns) if column < temps.shape[1]]
+        watched[:, present] = temps[:, [columns[i] for i in present]]
+
+        with self._lock:
+            if self.steady_time is not None:  # Found by another thread meanwhile
+                return self.steady_time
+            periods = np.floor(times * self.frequency).astype(np.int64)
+            if self.closed is None:
+                first = periods.min()
+                self.first_period = first if self.first_period is None else min(self.first_period, first)
+            # Runs of readings in the same period
+            edges = np.r_[0, np.flatnonzero(np.diff(periods)) + 1, len(times)]
+            for start, stop in zip(edges[:-1], edges[1:]):
+                period = periods[start]
+                if self.closed is not None and period <= self.closed:
+                    continue
+                count, y_sum, e_sum, z_sum = self.open.setdefault(period, self._new_sums())
+                y = watched[start:stop]
+                valid = ~np.isnan(y)
+                e = np.exp(-1j * self.omega * times[start:stop])[:, None]
+                count += valid.sum(axis=0)
+                y_sum += np.where(valid, y, 0).sum(axis=0)
+                e_sum += np.where(valid, e, 0).sum(axis=0)
+                z_sum += np.where(valid, y * e, 0).sum(axis=0)
+                read = valid.any(axis=0)
+                self.newest[read] = np.maximum(self.newest[read], period)
+
+            # Every channel has moved past the periods before the one the slowest is in
+            for period in sorted(period for period in self.open if period < self.newest.min()):
+                self._end_period(period, self.open.pop(period))
+                if self.steady_time is not None:
+                    self.open.clear()
+                    break
+            found = self.steady_time is not None
+
+        if found and self.on_steady is not None:
+            self.on_steady(self.steady_time)
+        return self.steady_time
+
+    def _new_sums(self):
+        n = len(self.channels)
+        return [np.zeros(n), np.zeros(n), np.zeros(n, dtype=complex), np.zeros(n, dtype=complex)]
+
+    def _end_period(self, period, sums):
+        count, y_sum, e_sum, z_sum = sums
+        if self.closed is not None and period != self.closed + 1:
+            self.last, self.still = None, 0  # Periods without a single reading in between
+        self.closed = period
+        if period == self.first_period or (count < 3).any():
+            self.last, self.still = None, 0
+            return
+
+        # Mean, and the DFT bin of the readings less their mean: b1/2 * exp(i(phase - pi/2)) for b1*sin(wt + phase)
+        mean = y_sum / count
+        z = (z_sum - mean * e_sum) / count
+        current = (mean, 2 * np.abs(z), np.angle(z))
+        if self.last is not None:
+            last_mean, last_amplitude, last_phase = self.last
+            amplitude = current[1]
+            still = (np.all(np.abs(mean - last_mean) <= self.mean_tolerance * amplitude)
+                     and np.all(np.abs(amplitude - last_amplitude) <= self.amplitude_tolerance * amplitude)
+                     and np.all(np.abs(np.angle(np.exp(1j * (current[2] - last_phase)))) <= self.phase_tolerance))
+            self.still = self.still + 1 if still else 0
+            if self.still >= self.periods:
+                # Steady from the start of the first period compared in the streak
+                self.steady_time = (period - self.periods) / self.frequency
+        self.last = current
+
+
+def detect(times, temps, frequency, channels=(1, 2)):
+    # Steady state time of recorded readings (a column per channel from channel 1), None if never steady
+    return SteadyStateDetector(frequency, channels).add(times, temps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", type=int, default=None, help="Run to check, the latest by default")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--dry-run", action="store_true", help="Print the steady state time without storing it")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    db.create_tables(conn)
+    cursor = conn.cursor()
+    run = db.get_run(cursor, args.run if args.run is not None else db.latest_run_id(cursor))
+    if run is None:
+        raise SystemExit(f"No run {args.run} in {args.db}")
+
+    channels = sorted(db.run_positions(run))
+    times, temps = load_run(cursor, run['run_id'], channels[-1])
+
+    steady_time = detect(times, temps, run['opamp_frequency'], channels)
+    if steady_time is None:
+        print(f"Run {run['run_id']} never reached steady state in {times[-1] if len(times) else 0:.0f} s")
+    else:
+        print(f"Run {run['run_id']} steady from {steady_time:.1f} s")
+        if not args.dry_run:
+            with conn:
+                conn.execute(db.UPDATE_STEADY_TIME, (steady_time, run['run_id']))
+    cursor.close()
+    conn.close()
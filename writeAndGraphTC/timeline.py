@@ -0,0 +1,133 @@
+# timeline.py
+# Background analysis stage: fits TC1 and TC2 over the window ending at every step (one period by default)
+# of a run and stores amplitude, phase and diffusivity in the results table, keyed on (run_id, relTime).
+# It picks up after the newest stored result, so rerunning it (or --follow while the run is recorded) only
+# fits what is new. The dashboard plots the stored timeline without refitting anything.
+# Each window is fit with a linear drift alongside the sine, like the dashboard's sliding fit, from prefix
+# sums of the normal equations: a block of steps costs one pass over its readings and one batched solve.
+# Blocks are sized by readings, not steps, so memory stays the same however long the run or period.
+
+import argparse
+import time
+import numpy as np
+import utils as ut
+import dbSchema as db
+from sampleWriter import connect
+from windowSweep import prefix_sums
+
+WINDOW_PERIODS = 2  # Periods of readings in each fit
+STEP_PERIODS = 1  # Periods between fits
+BLOCK_READINGS = 250000  # TC1 readings fit and committed together, the sums take ~30 floats per reading
+FOLLOW_INTERVAL = 5  # in s, time between catching up with --follow
+DATABASE_NAME = 'your_database.db'
+
+
+def fit_windows(times, temps, TempFrequency, ends, window):
+    # [b0, b1, b2] and adjusted R^2 of each column of temps over [end - window, end] for every end,
+    # fitting b0 + drift * t + b1*sin(2*pi*f*(t + b2)). Returns (ends x channels x 3) and (ends x channels)
+    G, h, q = prefix_sums(times, temps, TempFrequency, trend=True)
+    first = np.searchsorted(times, ends - window, side='left')
+    last = np.searchsorted(times, ends, side='right')
+    Gw, hw, qw = G[last] - G[first], h[last] - h[first], q[last] - q[first]
+
+    # Windows over a gap in the readings are left nan
+    n = (last - first)[:, None]
+    valid = n[:, 0] > 5
+    beta = np.full(hw.shape, np.nan)  # (ends x 4 x channels)
+    beta[valid] = np.linalg.solve(Gw[valid], hw[valid])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ss_res = qw - np.sum(beta * hw, axis=1)
+        ss_tot = qw - hw[:, 0] ** 2 / n
+        r2 = 1 - (ss_res / ss_tot) * ((n - 1) / (n - 5))
+
+    B, C = beta[:, 2], beta[:, 3]
+    omega = 2 * np.pi * TempFrequency
+    # b0 is the offset at the block's first reading, the drift is fit alongside
+    return np.stack((beta[:, 0], np.hypot(B, C), np.arctan2(C, B) / omega), axis=-1), r2
+
+
+def catch_up(conn, run, window_periods=WINDOW_PERIODS, step_periods=STEP_PERIODS, shift=None):
+    # Store the fits of every step after the newest stored result, returns how many were added
+    # shift is the time difference between TC1 and TC2, the run's (see dbSchema) when None
+    cursor = conn.cursor()
+    run_id, frequency = run['run_id'], run['opamp_frequency']
+    near, far, L = db.main_pair(run)
+    shift = db.run_tc_shift(run) if shift is None else shift
+    window, step = window_periods / frequency, step_periods / frequency
+    newest = [db.latest_value(cursor, run_id, channel) for channel in (1, 2)]
+    if None in newest:
+        return 0
+    newest = min(value[0] for value in newest)
+
+    last = db.latest_result_time(cursor, run_id)
+    if last is None:
+        # First window ends on a whole step
+        last = np.ceil((db.first_value(cursor, run_id, 1)[0] + window) / step) * step - step
+    ends = np.arange(last + step, newest + 1e-9, step)
+    if not len(ends):
+        return 0
+
+    # As many steps per block as keep it to BLOCK_READINGS, at the rate of the first window (one step at least)
+    rate = len(db.readings_between(cursor, run_id, 1, ends[0] - window, ends[0])) / window
+    block_steps = max(1, int((BLOCK_READINGS / max(rate, 1e-9) - window) / step))
+
+    added = 0
+    for block in range(0, len(ends), block_steps):
+        block_ends = ends[block:block + block_steps]
+        start, end = block_ends[0] - window, block_ends[-1]
+        times, temps1 = np.array(db.readings_between(cursor, run_id, 1, start, end), dtype=float).reshape(-1, 2).T
+        rows2 = np.array(db.readings_between(cursor, run_id, 2, start - 1, end + 1), dtype=float).reshape(-1, 2)
+        if len(times) < 10 or len(rows2) < 2:
+            continue
+        temps = np.column_stack((temps1, np.interp(times, rows2[:, 0], rows2[:, 1])))  # TC2 on TC1's times
+
+        params, r2 = fit_windows(times, temps, frequency, block_ends, window)
+        params[:, 1, 2] -= shift  # TC2 phase on TC1's clock
+        delta_time, amplitude_ratio, diffusivity, conductivity = ut.calculate_diffusivities(
+            params[:, near - 1], params[:, far - 1], frequency, L, run['density'], run['specific_heat'])
+        rows = np.column_stack((block_ends, np.full(len(block_ends), window), params[:, 0, 1], params[:, 0, 2],
+                                params[:, 1, 1], params[:, 1, 2], r2[:, 0], r2[:, 1], delta_time, amplitude_ratio,
+                                diffusivity, conductivity))
+        with conn:
+            conn.executemany(db.INSERT_RESULT, [(run_id, *map(float, row)) for row in rows])
+        added += len(rows)
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run", type=int, default=None, help="Run to analyze, the latest by default")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--window", type=float, default=WINDOW_PERIODS, help="Periods in each fit")
+    parser.add_argument("--step", type=float, default=STEP_PERIODS, help="Periods between fits")
+    parser.add_argument("--shift", type=float, default=None,
+                        help="Time difference between TC1 and TC2, the run's by default")
+    parser.add_argument("--follow", action="store_true", help="Keep catching up as the run is recorded, Ctrl+C to stop")
+    parser.add_argument("--redo", action="store_true", help="Delete the run's stored results first")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    db.create_tables(conn)
+    cursor = conn.cursor()
+    run = db.get_run(cursor, args.run if args.run is not None else db.latest_run_id(cursor))
+    if run is None:
+        raise SystemExit(f"No run {args.run} in {args.db}")
+    if args.redo:
+        with conn:
+            conn.execute(f"DELETE FROM {db.RESULT_TABLE} WHERE run_id = ?", (run['run_id'],))
+
+    try:
+        while 1:
+            start_time = time.perf_counter()
+            added = catch_up(conn, run, args.window, args.step, args.shift)
+            if added or not args.follow:
+                print(f"Run {run['run_id']}: {added} fits added in {time.perf_counter() - start_time:.2f} s, "
+                      f"up to {db.latest_result_time(cursor, run['run_id'])} s")
+            if not args.follow:
+                break
+            time.sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    cursor.close()
+    conn.close()
@@ -1,38 +1,68 @@
+import functools
 import numpy as np
 import pandas as pd
+import scipy.fft
 from scipy.optimize import curve_fit
 
+FIT_METHOD = 'linear'  # 'linear' closed-form least squares (frequency is known), 'curve_fit' iterative
+BOOTSTRAP_RESAMPLES = 200
+BOOTSTRAP_BLOCK = 0.1  # in periods, length of the residual blocks resampled together (keeps their correlation)
+BOOTSTRAP_CHUNK = 50  # Resamples computed per batch, bounds memory to chunk x readings
+FFT_PADDING = 4  # Zero padding of the frequency estimate's FFT, a finer spectrum to interpolate the peak on
+FREQUENCY_TOLERANCE = 0.05  # Relative difference between the configured and estimated frequency that is warned about
+
 
 # Define the model function
 def sinusoidal_model(x, b0, b1, b2, TempFrequency):
     return b0 + b1 * np.sin(2 * np.pi * TempFrequency * (x + b2))
 
 
-# Non-linear fitting
-def fit_data(temps, times, TempFrequency):
-    x_data = times
+# Linear least squares, the frequency is known so a + B*sin(wt) + C*cos(wt) is linear in a, B, C
+# temps can also be (samples x channels), every column is solved at once and each row of the result is (channels,)
+def fit_linear(temps, times, TempFrequency):
+    omega = 2 * np.pi * TempFrequency
+    X = np.column_stack((np.ones_like(times), np.sin(omega * times), np.cos(omega * times)))
 
-    y_data = temps
+    # Normal equations, a 3x3 solve whatever the number of readings
+    a, B, C = np.linalg.solve(X.T @ X, X.T @ temps)
 
-    if len(x_data) != len(y_data) or len(x_data) == 0 or len(y_data) == 0:
-        raise ValueError("x_data and y_data must have the same non-zero length")
+    # B*sin(wt) + C*cos(wt) = b1*sin(w(t + b2)) with b1 = |(B, C)| and w*b2 the angle of (B, C)
+    return np.array([a, np.hypot(B, C), np.arctan2(C, B) / omega])
 
-    # initial guess
-    p0 = [np.mean(y_data), np.max(y_data) - np.mean(y_data), np.pi]
 
-    if len(p0) != 3:  # Assuming your model has 3 parameters
-        raise ValueError("Initial parameter vector p0 must have length 3")
+# Non-linear fitting
+def fit_curve(temps, times, TempFrequency):
+    # initial guess
+    p0 = [np.mean(temps), np.max(temps) - np.mean(temps), np.pi]
 
     # Define a lambda function to pass TempFrequency as an additional parameter
     model_func = lambda x, a, b, phi: sinusoidal_model(x, a, b, phi, TempFrequency)
 
     try:
-        popt, _ = curve_fit(model_func, x_data, y_data, p0=p0)  # fit the model
+        popt, _ = curve_fit(model_func, times, temps, p0=p0)  # fit the model
     except Exception as e:
         raise RuntimeError(f"Curve fitting failed with error: {str(e)}")
+    return popt
+
+
+def fit_data(temps, times, TempFrequency, method=FIT_METHOD):
+    # Fit b0 + b1*sin(2*pi*f*(t + b2)), returns [b0, b1, b2] and the adjusted R squared
+    x_data = np.asarray(times, dtype=float)
+
+    y_data = np.asarray(temps, dtype=float)
+
+    if len(x_data) != len(y_data) or len(x_data) == 0 or len(y_data) == 0:
+        raise ValueError("x_data and y_data must have the same non-zero length")
+
+    if method == 'linear':
+        popt = fit_linear(y_data, x_data, TempFrequency)
+    elif method == 'curve_fit':
+        popt = fit_curve(y_data, x_data, TempFrequency)
+    else:
+        raise ValueError(f"Unknown fit method {method}, 'linear' or 'curve_fit'")
 
     # Predicted y_data
-    y_pred = model_func(x_data, *popt)
+    y_pred = sinusoidal_model(x_data, *popt, TempFrequency)
 
     # Calculate R squared
     residuals = y_data - y_pred
@@ -42,24 +72,238 @@ def fit_data(temps, times, TempFrequency):
 
     # Calculate the adjusted R-squared
     n = len(x_data)
-    p = len(p0)
+    p = len(popt)
     adjusted_r_squared = 1 - (1 - r_squared) * ((n - 1) / (n - p - 1))
 
     return popt, adjusted_r_squared
 
 
-def process_data(lst, sampling_rate, temp_frequency):
-    window_size = int(min((sampling_rate // temp_frequency), len(lst)/2))
+def fit_channels(temps, times, TempFrequency):
+    # fit_data for every column of a (samples x channels) array on the same times, in one solve
+    # Returns a row of [b0, b1, b2] per channel and the adjusted R squared of each channel
+    temps = np.asarray(temps, dtype=float)
+    times = np.asarray(times, dtype=float)
+    popt = fit_linear(temps, times, TempFrequency).T
+
+    y_pred = sinusoidal_model(times[:, None], popt[:, 0], popt[:, 1], popt[:, 2], TempFrequency)
+    ss_res = np.sum((temps - y_pred) ** 2, axis=0)
+    ss_tot = np.sum((temps - np.mean(temps, axis=0)) ** 2, axis=0)
+    n, p = len(times), popt.shape[1]
+    adjusted_r_squared = 1 - (ss_res / ss_tot) * ((n - 1) / (n - p - 1))
+    return popt, adjusted_r_squared
+
+
+def calculate_diffusivities(params1, params2, TempFrequency, L, density=1, specific_heat=1):
+    # Diffusivity from fits [b0, b1, b2] of TCs L apart, TC2 being further from the heater, for any number of
+    # windows or pairs at once: params1 and params2 are (..., 3) arrays, L broadcasts against them.
+    # Returns arrays of the phase lag delta_time, the amplitude ratio M / N, the diffusivity
+    # L^2 / (2 * delta_time * ln(M / N)) and the conductivity
+    params1, params2 = np.asarray(params1, dtype=float), np.asarray(params2, dtype=float)
+    period = 1 / TempFrequency
+
+    # A negative amplitude is the same wave half a period later
+    phase1 = params1[..., 2] + period / 2 * (params1[..., 1] < 0)
+    phase2 = params2[..., 2] + period / 2 * (params2[..., 1] < 0)
+
+    # TC2 lags TC1 by less than a period: the time from TC1's phase back to TC2's, modulo the period
+    # (what reducing both phase shifts to (-period, 0] and moving TC2 a period earlier if it is after TC1 gives)
+    delta_time = np.mod(phase1 - phase2, period)
+    amplitude_ratio = np.abs(params1[..., 1]) / np.abs(params2[..., 1])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffusivity = np.asarray(L, dtype=float) ** 2 / (2 * delta_time * np.log(amplitude_ratio))
+    return delta_time, amplitude_ratio, diffusivity, diffusivity * density * specific_heat
+
+
+def pair_diffusivities(params, positions, TempFrequency):
+    # Diffusivity of every pair of channels, params one row of [b0, b1, b2] per channel at the given positions
+    # (distance from the heater). Returns (i, j, diffusivity) with channel i nearer the heater than j
+    params = np.asarray(params, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    order = np.argsort(positions)
+    a, b = np.triu_indices(len(order), 1)
+    i, j = order[a], order[b]
+    keep = positions[j] > positions[i]
+    i, j = i[keep], j[keep]
+    diffusivity = calculate_diffusivities(params[i], params[j], TempFrequency, positions[j] - positions[i])[2]
+    return [(int(i), int(j), float(d)) for i, j, d in zip(i, j, diffusivity)]
+
+
+def position_regression(params, positions, TempFrequency):
+    # Fit ln(amplitude) and phase lag against position over all channels (Angstrom's method):
+    # amplitude decays as exp(-alpha * x) and the phase lags by beta * x, diffusivity = w / (2 * alpha * beta).
+    # Each channel is taken to lag the one before it (by position) by less than a period, as in calculate_diffusivities
+    omega = 2 * np.pi * TempFrequency
+    order = np.argsort(positions)
+    x = np.asarray(positions, dtype=float)[order]
+    amplitude = np.abs(np.asarray(params)[order, 1])
+    lag = -omega * np.asarray(params)[order, 2] + np.pi * (np.asarray(params)[order, 1] < 0)
+    lag = np.r_[0, np.cumsum(np.mod(np.diff(lag), 2 * np.pi))]
+
+    alpha = -np.polyfit(x, np.log(amplitude), 1)[0]
+    beta = np.polyfit(x, lag, 1)[0]
+    return omega / (2 * alpha * beta), alpha, beta
+
+
+def bootstrap_diffusivity(temps1, times1, temps2, times2, TempFrequency, L, resamples=BOOTSTRAP_RESAMPLES,
+                          confidence=0.95, block_periods=BOOTSTRAP_BLOCK, seed=None):
+    # Moving-block residual bootstrap of the diffusivity of two TCs fit with fit_linear.
+    # The fits are linear, so a resample's coefficients are the fit's plus the projection of its resampled
+    # residuals: one (3 x readings) @ (readings x resamples) product per TC for a whole batch of resamples.
+    # Both TCs take the same blocks so their correlated noise stays together.
+    # Returns the (low, high) confidence interval and the diffusivity of every resample
+    omega = 2 * np.pi * TempFrequency
+    times1, times2 = np.asarray(times1, dtype=float), np.asarray(times2, dtype=float)
+    n = min(len(times1), len(times2))
+    rng = np.random.default_rng(seed)
+
+    coefficients, residuals, projections = [], [], []
+    for temps, times in ((temps1, times1), (temps2, times2)):
+        X = np.column_stack((np.ones(n), np.sin(omega * times[:n]), np.cos(omega * times[:n])))
+        projection = np.linalg.solve(X.T @ X, X.T)  # (3 x readings), coefficients = projection @ temps
+        beta = projection @ np.asarray(temps, dtype=float)[:n]
+        coefficients.append(beta)
+        residuals.append(np.asarray(temps, dtype=float)[:n] - X @ beta)
+        projections.append(projection)
+
+    sampling_rate = (n - 1) / (times1[n - 1] - times1[0])
+    block = int(np.clip(round(block_periods * sampling_rate / TempFrequency), 1, n))
+    n_blocks = -(-n // block)
+
+    diffusivities = []
+    for done in range(0, resamples, BOOTSTRAP_CHUNK):
+        batch = min(BOOTSTRAP_CHUNK, resamples - done)
+        starts = rng.integers(0, n - block + 1, size=(batch, n_blocks))
+        index = (starts[:, :, None] + np.arange(block)).reshape(batch, -1)[:, :n]
+
+        params = []
+        for beta, residual, projection in zip(coefficients, residuals, projections):
+            a, B, C = beta[:, None] + projection @ residual[index].T
+            params.append(np.column_stack((a, np.hypot(B, C), np.arctan2(C, B) / omega)))
+        diffusivities.append(calculate_diffusivities(*params, TempFrequency, L)[2])
+
+    diffusivities = np.concatenate(diffusivities)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.nanpercentile(diffusivities, [tail, 100 - tail])
+    return (low, high), diffusivities
+
+
+def process_data(lst, sampling_rate, temp_frequency, out=None):
+    # Remove a centered moving average of one period (the same as pandas rolling(window, min_periods=1,
+    # center=True).mean()) from a 1-D array or every column of a 2-D (samples x channels) array at once.
+    # out can be a preallocated array of the same shape, or the input itself to detrend in place.
+    temps = np.asarray(lst, dtype=float)
+    n = len(temps)
+    window_size = max(1, int(min((sampling_rate // temp_frequency), n / 2)))
+
+    # Window of each sample, clipped at the ends like min_periods=1
+    index = np.arange(n)
+    lo = np.maximum(index - window_size // 2, 0)
+    hi = np.minimum(index + (window_size - 1) // 2 + 1, n)
+    counts = (hi - lo).reshape((n,) + (1,) * (temps.ndim - 1))
+
+    # Sums from a cumulative sum, taken around the first sample to keep the rounding small
+    offset = temps[:1]
+    sums = np.zeros((n + 1,) + temps.shape[1:])
+    np.cumsum(temps - offset, axis=0, out=sums[1:])
+    moving_avg = (sums[hi] - sums[lo]) / counts + offset
+
+    if out is None:
+        return temps - moving_avg
+    np.subtract(temps, moving_avg, out=out)
+    return out
+
+
+def get_fft_data(output, sf, n=None):
+    # One-sided amplitude spectrum of 'output' sampled at sf, as archive/src/utils/utils_first.py's but with
+    # rfft, which only computes the non-negative frequencies. n > len(output) zero pads for finer frequency steps
+    output = np.asarray(output, dtype=float)
+    n = n or len(output)
+    intensity = np.abs(scipy.fft.rfft(output, n)) / len(output)
+
+    # Double the values (except for DC and Nyquist frequencies)
+    intensity[1:-1] = 2 * intensity[1:-1]
+    frequency = scipy.fft.rfftfreq(n, 1 / sf)
+    return frequency, intensity
+
+
+@functools.lru_cache(maxsize=16)
+def fft_plan(n):
+    # Padded FFT length (a fast size for scipy) and Hann window for n readings, reused by windows of the same length
+    return scipy.fft.next_fast_len(FFT_PADDING * n, real=True), np.hanning(n)
+
+
+def sine_power(temps, frequency):
+    # Sum of squares of evenly sampled temps explained by a least squares sine of frequency (in cycles per reading)
+    # With a mean and linear drift fit alongside, temps being already detrended
+    x = np.arange(len(temps))
+    phase = 2 * np.pi * frequency * x
+    X = np.column_stack((np.ones(len(temps)), x - x.mean(), np.sin(phase), np.cos(phase)))
+    Xty = X.T @ temps
+    return np.linalg.solve(X.T @ X, Xty) @ Xty
+
+
+def estimate_frequency(temps, sampling_rate, refine=3):
+    # Frequency of the strongest oscillation in evenly sampled temps: peak of the windowed, zero padded spectrum,
+    # then `refine` rounds of a parabola through the power of least squares sine fits either side of it, which
+    # unlike the spectrum has no pull from the negative frequency with only a few periods of data.
+    # Needs two periods or so of data
+    temps = np.asarray(temps, dtype=float)
+    n = len(temps)
+    if n < 8:
+        raise ValueError(f"Frequency estimate needs at least 8 readings, has {n}")
+    length, window = fft_plan(n)
+
+    # Remove the mean and a linear drift, which would otherwise leak into the lowest frequencies
+    x = np.arange(n) - (n - 1) / 2
+    detrended = temps - temps.mean() - x * (x @ temps) / (x @ x)
+    _, spectrum = get_fft_data(detrended * window, sampling_rate, length)
+
+    # Below one cycle per window is what is left of the drift
+    first = max(1, int(length / n))
+    frequency = (first + np.argmax(spectrum[first:-1])) / length  # in cycles per reading
+    step = 0.5 / n
+    for _ in range(refine):
+        a, b, c = (sine_power(detrended, frequency + k * step) for k in (-1, 0, 1))
+        if a - 2 * b + c < 0:
+            frequency += step * np.clip(0.5 * (a - c) / (a - 2 * b + c), -1, 1)
+        step /= 4
+    return frequency * sampling_rate
+
+
+def frequency_warning(configured, estimated, tolerance=FREQUENCY_TOLERANCE):
+    # Message when the configured frequency is off from the estimate by more than tolerance, else None
+    if not np.isfinite(estimated) or abs(estimated - configured) <= tolerance * configured:
+        return None
+    return (f"Configured frequency {configured:g} Hz but the data oscillates at {estimated:.4g} Hz "
+            f"({estimated / configured:.2f}x)")
+
+
+def minmax_indices(times, values, bucket_width, origin=0.0):
+    # Indices of the min and max reading of each bucket_width slice of time, in time order.
+    # A line plot can't show more than that per pixel, so with one bucket per pixel or two the plot looks the same.
+    # Buckets are aligned to origin so decimating a trace piece by piece gives the same points as all at once.
+    times = np.asarray(times)
+    if len(times) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    values = np.asarray(values)
+    buckets = np.floor((times - origin) / bucket_width).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    lengths = np.diff(np.r_[starts, len(buckets)])
+    bucket_of = np.repeat(np.arange(len(starts)), lengths)
 
-    # print(sampling_rate // temp_frequency)
-    # print(len(lst)/2)
-    # print(window_size)
+    # First reading of each bucket equal to the bucket's min (max)
+    keep = []
+    for extreme in (np.minimum, np.maximum):
+        hits = np.flatnonzero(values == np.repeat(extreme.reduceat(values, starts), lengths))
+        keep.append(hits[np.r_[True, bucket_of[hits[1:]] != bucket_of[hits[:-1]]]])
+    return np.union1d(*keep)
 
-    column_series = pd.Series(lst)
-    moving_avg = column_series.rolling(window=window_size, min_periods=1, center=True).mean()
-    lst = list(column_series - moving_avg)
 
-    return lst
+def minmax_decimate(times, values, bucket_width, origin=0.0):
+    keep = minmax_indices(times, values, bucket_width, origin)
+    return np.asarray(times)[keep], np.asarray(values)[keep]
 
 
 def clean_dataframe(df: pd.DataFrame) -> pd.DataFrame:
@@ -0,0 +1,169 @@
+# windowSweep.py
+# Picks the fit window instead of clicking it (plt.ginput in archive/src/main.py): the TC1/TC2 diffusivity and
+# fit R^2 of every window on a grid of start times and lengths (whole periods) over a whole run or csv export.
+# The data is detrended once, then every window's fit comes from prefix sums of the fit_linear normal equations,
+# so a window costs one batched 3x3 solve whatever its length.
+# Writes a heat map of the diffusivity and of how much it changes between neighbouring windows, and suggests the
+# most stable window with a good fit (as start/end for the batchAnalysis manifest).
+
+import argparse
+import time
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from bokeh.plotting import figure, output_file, save
+from bokeh.models import LinearColorMapper, ColorBar
+from bokeh.layouts import column
+from bokeh.palettes import Viridis256
+import utils as ut
+import dbSchema as db
+import batchAnalysis as ba
+
+STEP = 0.5  # in periods, between window start times
+LENGTHS = range(1, 21)  # in periods, window lengths swept
+R2_MIN = 0.9  # Lowest adjusted R^2 (of either TC) a suggested window may have
+NEIGHBOURS = 1  # Windows either side (in start and in length) the stability is taken over
+HEAT_MAP = 'window_sweep.html'
+
+
+def prefix_sums(times, temps, TempFrequency, trend=False):
+    # Sums of the normal equations over the first k readings, k = 0..n: G of x x^T with x = (1, sin wt, cos wt),
+    # h of x * temp and q of temp^2 for every column of temps (samples x channels).
+    # trend adds t - times[0] to x, after the 1, for a linear drift fit with the sine
+    omega = 2 * np.pi * TempFrequency
+    columns = [np.ones_like(times)] + ([times - times[0]] if trend else [])
+    X = np.column_stack(columns + [np.sin(omega * times), np.cos(omega * times)])
+    n, channels = temps.shape
+    G = np.zeros((n + 1, X.shape[1], X.shape[1]))
+    h = np.zeros((n + 1, X.shape[1], channels))
+    q = np.zeros((n + 1, channels))
+    np.cumsum(X[:, :, None] * X[:, None, :], axis=0, out=G[1:])
+    np.cumsum(X[:, :, None] * temps[:, None, :], axis=0, out=h[1:])
+    np.cumsum(temps ** 2, axis=0, out=q[1:])
+    return G, h, q
+
+
+def sweep(times, temps, TempFrequency, L, shift=0.0, step=STEP, lengths=LENGTHS):
+    # Fits both columns of temps (TC1, TC2 detrended) in every window starting each `step` periods and
+    # `lengths` periods long. Returns the start times, lengths, and (starts x lengths) arrays of the
+    # diffusivity and of the lower adjusted R^2 of the two TCs, nan for windows running past the data
+    period = 1 / TempFrequency
+    lengths = np.asarray(lengths, dtype=float)
+    starts = np.arange(times[0], times[-1] - lengths.min() * period, step * period)
+    ends = starts[:, None] + lengths * period
+    first = np.searchsorted(times, starts)[:, None] * np.ones(len(lengths), dtype=int)
+    last = np.searchsorted(times, ends, side='right')
+    valid = (ends <= times[-1]) & (last - first > 4)
+
+    G, h, q = prefix_sums(times, temps, TempFrequency)
+    first, last = first[valid], last[valid]
+    Gw = G[last] - G[first]
+    hw = h[last] - h[first]
+    qw = q[last] - q[first]
+    a, B, C = np.moveaxis(np.linalg.solve(Gw, hw), 1, 0)  # (windows x channels) each
+
+    # R^2 from the sums: residual sum of squares is q - beta.h at the least squares solution
+    n = Gw[:, 0, 0][:, None]
+    ss_res = qw - (a * hw[:, 0] + B * hw[:, 1] + C * hw[:, 2])
+    ss_tot = qw - hw[:, 0] ** 2 / n
+    r2 = 1 - (ss_res / ss_tot) * ((n - 1) / (n - 4))
+
+    omega = 2 * np.pi * TempFrequency
+    b2 = np.arctan2(C, B) / omega
+    b2[:, 1] -= shift  # TC2 on TC1's clock
+    params = np.stack((a, np.hypot(B, C), b2), axis=-1)  # (windows x channels x 3)
+    diffusivity = np.full(valid.shape, np.nan)
+    diffusivity[valid] = ut.calculate_diffusivities(params[:, 0], params[:, 1], TempFrequency, L)[2]
+    fit = np.full(valid.shape, np.nan)
+    fit[valid] = r2.min(axis=1)
+    return starts, lengths, diffusivity, fit
+
+
+def stability(diffusivity, neighbours=NEIGHBOURS):
+    # Relative spread (std / mean) of the diffusivity over each window's neighbours in start and length
+    size = 2 * neighbours + 1
+    padded = np.pad(diffusivity, neighbours, constant_values=np.nan)
+    around = sliding_window_view(padded, (size, size)).reshape(diffusivity.shape + (-1,))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-nan neighbourhoods past the end of the data
+        spread = np.nanstd(around, axis=-1) / np.abs(np.nanmean(around, axis=-1))
+    spread[np.isnan(diffusivity)] = np.nan
+    return spread
+
+
+def suggest(diffusivity, fit, spread, r2_min=R2_MIN):
+    # (start index, length index) of the most stable window with a positive diffusivity and both R^2 >= r2_min
+    candidates = np.where((fit >= r2_min) & (diffusivity > 0) & np.isfinite(spread), spread, np.inf)
+    if not np.isfinite(candidates).any():
+        return None
+    return np.unravel_index(np.argmin(candidates), candidates.shape)
+
+
+def heat_map(starts, lengths, values, title, **kwargs):
+    # Image of (starts x lengths) values, start time across and length in periods up
+    plot = figure(title=title, width=900, height=350, x_axis_label='Window start (s)',
+                  y_axis_label='Window length (periods)', **kwargs)
+    finite = values[np.isfinite(values)]
+    mapper = LinearColorMapper(palette=Viridis256, nan_color='white',
+                               low=np.percentile(finite, 2) if len(finite) else 0,
+                               high=np.percentile(finite, 98) if len(finite) else 1)
+    width = starts[-1] - starts[0] + (starts[1] - starts[0] if len(starts) > 1 else 1)
+    plot.image(image=[values.T], x=starts[0], y=lengths[0] - 0.5, dw=width, dh=len(lengths), color_mapper=mapper)
+    plot.add_layout(ColorBar(color_mapper=mapper), 'right')
+    return plot
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="csv export or run database")
+    parser.add_argument("--run", type=int, default=None, help="Run to sweep in a database, the latest by default")
+    parser.add_argument("--manifest", default=ba.MANIFEST, help="Settings for csv exports, as for batchAnalysis")
+    parser.add_argument("--frequency", type=float, default=None, help="Temperature frequency, overrides the manifest")
+    parser.add_argument("--L", type=float, default=None)
+    parser.add_argument("--channels", default=None, help="TC1 and TC2 columns (or channels), e.g. 'TC3 TC4'")
+    parser.add_argument("--shift", type=float, default=None, help="Time difference between TC1 and TC2")
+    parser.add_argument("--step", type=float, default=STEP, help="Periods between window starts")
+    parser.add_argument("--lengths", type=int, nargs='+', default=list(LENGTHS), help="Window lengths in periods")
+    parser.add_argument("--r2-min", type=float, default=R2_MIN)
+    parser.add_argument("--out", default=HEAT_MAP)
+    args = parser.parse_args()
+
+    jobs = ba.make_jobs([args.source], ba.read_manifest(args.manifest))
+    if args.run is not None:
+        jobs = [job for job in jobs if job['run'] == args.run]
+    if not jobs:
+        raise SystemExit(f"No run {args.run} in {args.source}")
+    job = jobs[-1]
+    overrides = {'frequency': args.frequency, 'L': args.L, 'channels': args.channels, 'shift': args.shift}
+    job.update({key: value for key, value in overrides.items() if value is not None})
+    if 'frequency' not in job or 'L' not in job or 'channels' not in job:
+        raise SystemExit("Give --frequency, --L and --channels (or a manifest row for this file)")
+    frequency, L, shift = float(job['frequency']), float(job['L']), float(job.get('shift', db.TC_TIME_SHIFT))
+
+    start_time = time.perf_counter()
+    times, temps = ba.load_readings(job)
+    temps = ut.process_data(temps[:, :2], (len(times) - 1) / (times[-1] - times[0]), frequency)
+    starts, lengths, diffusivity, fit = sweep(times, temps, frequency, L, shift, args.step, args.lengths)
+    spread = stability(diffusivity)
+    best = suggest(diffusivity, fit, spread, args.r2_min)
+    print(f"{np.isfinite(diffusivity).sum()} windows over {len(times)} readings in "
+          f"{time.perf_counter() - start_time:.2f} s")
+
+    diffusivity_plot = heat_map(starts, lengths, diffusivity, f"Diffusivity, {job['source']} {job['run']}")
+    spread_plot = heat_map(starts, lengths, spread, "Relative change to neighbouring windows",
+                           x_range=diffusivity_plot.x_range, y_range=diffusivity_plot.y_range)
+    fit_plot = heat_map(starts, lengths, fit, "Adjusted R^2 (lower of TC1, TC2)",
+                        x_range=diffusivity_plot.x_range, y_range=diffusivity_plot.y_range)
+    if best is not None:
+        i, j = best
+        start, end = starts[i], starts[i] + lengths[j] / frequency
+        for plot in (diffusivity_plot, spread_plot, fit_plot):
+            plot.scatter([start], [lengths[j]], size=12, marker='x', color='red')
+        print(f"Suggested window {start:.1f} - {end:.1f} s ({lengths[j]:.0f} periods): diffusivity "
+              f"{diffusivity[i, j]}, R^2 {fit[i, j]:.4f}, changes {spread[i, j]:.2%} to its neighbours")
+        print(f"Manifest columns start,end: {start:.1f},{end:.1f}")
+    else:
+        print(f"No window has both R^2 >= {args.r2_min}, try a lower --r2-min")
+    output_file(args.out, title="Window sweep")
+    save(column(diffusivity_plot, spread_plot, fit_plot))
+    print(f"Heat map in {args.out}")
@@ -1,69 +1,158 @@
 # writeFromCSV.py
-# Writes to a database temperature data from CSV file
-# Speed can be set to simulate live data transfer
+# Writes to a database temperature data from a PicoLog CSV file, replayed like a live run
+# The file is read in chunks and rows are released at the recorded sample cadence times --speed
+# (1, 10, 100, ... or 0 for as fast as the writer takes them), through the same writer and ring buffer as the DAQ
 
-import sqlite3
+import argparse
+import threading
+import time
+import numpy as np
 import pandas as pd
 import utils as ut
-import time
+import dbSchema as db
+from sampleWriter import SampleWriter, connect
+from ringBuffer import RingBuffer, RING_BUFFER_PATH
+from steadyState import SteadyStateDetector
 
-VALUES_TO_READ = 2000
-SLEEP_TIME = 1
+CSV_FILE = "fully_converted_AlStrip_TC34_10msSampling_MountedTCs_L=0.71cm_TIMpaste_24VCPUFan_f=0.001.plw_1.csv"
+CHANNEL_MAP = {'TC3': 1, 'TC4': 2}  # CSV column -> database channel
+CHUNK_SIZE = 10000  # CSV rows read at a time
+SAMPLING_RATE = 1 / 0.01  # PicoLog export sampling
+SPEED = 1  # Replay speed factor, 0 for as fast as possible
+EMIT_INTERVAL = 0.05  # in s, how often due rows are released
+REPORT_INTERVAL = 5  # in s, time between printing the achieved rate
 DATABASE_NAME = 'your_database.db'
-TABLE_NAME = "Data1"
-
-# Connect to the database
-conn = sqlite3.connect(DATABASE_NAME)
-
-# Create a cursor
-cursor = conn.cursor()
-
-directory = "fully_converted_AlStrip_TC34_10msSampling_MountedTCs_L=0.71cm_TIMpaste_24VCPUFan_f=0.001.plw_1.csv"
-
-# Read the original CSV file
-df = pd.read_csv(directory)
-df = ut.clean_dataframe(df)
-
-# create lists to store data
-
-date_times = list(df['Date/Time'])
-times1 = [i * 0.01 for i in range(len(df))]
-temps1 = list(df['TC3'])
-temps2 = list(df['TC4'])
-temps5 = list(df['TC5'])
-temps6 = list(df['TC6'])
-
-# Create a table
-cursor.execute(f'''CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-                date_time TEXT NOT NULL,
-                relTime REAL NOT NULL,
-                temp1 REAL NOT NULL,
-                temp2 REAL NOT NULL,
-                temp3 REAL,
-                temp4 REAL,
-                temp5 REAL,
-                temp6 REAL,
-                temp7 REAL,
-                temp8 REAL,
-                power REAL)''')
-
-for i in range(0, len(temps1), VALUES_TO_READ):
-    time.sleep(SLEEP_TIME)
-
-    # Add data
-    date_time = date_times[i:i + VALUES_TO_READ]
-    time1 = times1[i:i + VALUES_TO_READ]
-    temp1 = temps1[i:i + VALUES_TO_READ]
-    temp2 = temps2[i:i + VALUES_TO_READ]
-
-    data_to_insert = list(zip(date_time, time1, temp1, temp2))
-
-    cursor.executemany(f"INSERT INTO {TABLE_NAME} (date_time, relTime, temp1, temp2) VALUES (?, ?, ?, ?)",
-                       data_to_insert)
-
-    # Commit the changes to the database
-    conn.commit()
-
-# Close the cursor and the connection
-cursor.close()
-conn.close()
+
+
+def parse_channel_map(pairs):
+    # ["TC3=1", "TC4=2"] -> {'TC3': 1, 'TC4': 2}
+    mapping = {}
+    for pair in pairs:
+        column, channel = pair.rsplit('=', 1)
+        mapping[column] = int(channel)
+    return mapping
+
+
+def read_chunks(csv_file, channel_map, sampling_rate=SAMPLING_RATE, chunk_size=CHUNK_SIZE):
+    # Yield (times, temps) arrays per chunk, temps has one column per mapped channel
+    sample_index = 0
+    for df in pd.read_csv(csv_file, chunksize=chunk_size):
+        df = ut.clean_dataframe(df)
+        missing = set(channel_map) - set(df.columns)
+        if missing:
+            raise ValueError(f"Columns {sorted(missing)} not in {csv_file}, columns are {list(df.columns)}")
+
+        times = (sample_index + np.arange(len(df))) / sampling_rate
+        sample_index += len(df)
+        yield times, df[list(channel_map)].to_numpy(dtype=np.float64)
+
+
+def replay(chunks, channels, writer, ring, run_id, speed=SPEED, detector=None):
+    block = speed == 0  # As fast as possible waits for the writer instead of dropping samples
+    ring_columns = np.array(channels)  # Ring buffer column of each mapped channel
+
+    start_wall = time.perf_counter()
+    start_time = None
+    last_report = start_wall
+    emitted = 0
+    emitted_at_report = 0
+    sample_time = 0.0
+    sample_time_at_report = 0.0
+
+    for times, temps in chunks:
+        if start_time is None and len(times):
+            start_time = times[0]
+        i = 0
+        while i < len(times):
+            # Release every row whose recorded time has come at this speed
+            if speed:
+                due = start_time + (time.perf_counter() - start_wall) * speed
+                j = int(np.searchsorted(times, due, side='right'))
+                if j == i:
+                    time.sleep(min(EMIT_INTERVAL, (times[i] - due) / speed))
+                    continue
+            else:
+                j = len(times)
+
+            for k in range(i, j):
+                for channel, temp in zip(channels, temps[k]):
+                    writer.put(db.INSERT_SAMPLE, (run_id, channel, times[k], temp), block)
+
+            rows = np.full((j - i, ring.n_columns), np.nan)
+            rows[:, 0] = times[i:j]
+            rows[:, ring_columns] = temps[i:j]
+            ring.append(rows)
+            if detector is not None:
+                detector.add(rows[:, 0], rows[:, 1:])
+
+            emitted += j - i
+            sample_time = times[j - 1]
+            i = j
+
+            now = time.perf_counter()
+            if now - last_report >= REPORT_INTERVAL:
+                rate = (emitted - emitted_at_report) / (now - last_report)
+                factor = (sample_time - sample_time_at_report) / (now - last_report)
+                stats = writer.stats()
+                print(f"{sample_time:.1f} s replayed, {rate:.0f} rows/s ({factor:.1f}x real time), "
+                      f"writer queue depth {stats['queue_depth']}, dropped {stats['dropped']}")
+                last_report = now
+                emitted_at_report = emitted
+                sample_time_at_report = sample_time
+
+    elapsed = time.perf_counter() - start_wall
+    print(f"Replayed {emitted} rows ({sample_time:.1f} s of data) in {elapsed:.1f} s, "
+          f"{emitted / max(elapsed, 1e-9):.0f} rows/s")
+    return emitted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv", nargs="?", default=CSV_FILE)
+    parser.add_argument("--speed", type=float, default=SPEED, help="Replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--map", nargs="+", default=[f"{column}={channel}" for column, channel in CHANNEL_MAP.items()],
+                        help="CSV column to database channel, e.g. TC3=1 TC4=2")
+    parser.add_argument("--sampling-rate", type=float, default=SAMPLING_RATE, help="Sampling rate of the file")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--ring", default=RING_BUFFER_PATH, help="Ring buffer file the dashboard reads live data from")
+    db.add_run_arguments(parser)
+    args = parser.parse_args()
+    channel_map = parse_channel_map(args.map)
+
+    # Create the tables and a run for this file
+    conn = connect(args.db)
+    db.create_tables(conn)
+    run_id = db.create_run_from_args(conn, args, args.sampling_rate)
+    conn.close()
+    print(f"Recording run {run_id}")
+
+    writer = SampleWriter(args.db)
+    writer.start()
+    ring = RingBuffer.create(args.ring, n_channels=max(db.TC_CHANNELS[-1], *channel_map.values()), run_id=run_id)
+
+    # Stores when the run settles into periodic steady state, watching the placed TCs (TC1 and TC2 by default)
+    # It is queued from a thread of its own, the acquisition thread that found it never waits on the writer
+    steady_threads = []
+
+    def on_steady(steady_time):
+        thread = threading.Thread(target=writer.put, args=(db.UPDATE_STEADY_TIME, (steady_time, run_id), True),
+                                  name="steady-time", daemon=True)
+        thread.start()
+        steady_threads.append(thread)
+        print(f"Steady state from {steady_time:.1f} s")
+
+    watched = range(1, len(args.positions) + 1) if args.positions else (1, 2)
+    detector = SteadyStateDetector(args.frequency, watched, on_steady=on_steady)
+
+    try:
+        replay(read_chunks(args.csv, channel_map, args.sampling_rate, args.chunk), list(channel_map.values()),
+               writer, ring, run_id, args.speed, detector)
+    except KeyboardInterrupt:
+        pass
+
+    # Close the ring buffer and write out the remaining queued samples
+    ring.close()
+    for thread in steady_threads:
+        thread.join()
+    writer.stop()
@@ -1,115 +1,308 @@
-import sqlite3
+# writeFromDAQ.py
+# Writes to a database temperature data from a Pico TC-08
+# Stream mode (default) lets the TC-08 sample on its own clock with usb_tc08_run and drains its buffer,
+# poll mode times each usb_tc08_get_single read on the host and is kept as a fallback
+# Several units (--units) are read concurrently, one worker thread each, unit n records channels 8n+1..8n+8
+
+import argparse
 import ctypes
+import threading
 import time
+import numpy as np
 from picosdk.usbtc08 import usbtc08 as tc08
 from picosdk.functions import assert_pico2000_ok
+from sampleWriter import SampleWriter, connect
+from ringBuffer import RingBuffer, RING_BUFFER_PATH
+from steadyState import SteadyStateDetector
+import dbSchema as db
 
 OPEN_CHANNELS = 2  # 2 TCs, opens 2 Channels + CJ = 3. Keep at 2.
 CHANNELS_TO_ADD = 6  # +6 TCs gets to 8 Channels open. Maximum of 6.
 CYCLES_UNTIL_LARGE_READ = 5
 TC_LAG = 0.068
+STATS_INTERVAL = 10  # in s, time between printing writer queue depth and flush latency
+DATABASE_NAME = 'your_database.db'
+ACQUISITION_MODE = "stream"  # "stream" for usb_tc08_run + get_temp_deskew, "poll" for usb_tc08_get_single
+
+# Stream mode
+STREAM_WAKEUP = 1  # in s, time between draining the TC-08 buffer
+STREAM_BUFFER_SIZE = 600  # Readings per channel the TC-08 driver buffers between reads
+
+# Poll mode
+POLL_SAMPLING_RATE = 1 / 0.2  # Approximate rate of the fast channels, recorded with the run
 
-# Connect to the database
-conn = sqlite3.connect('your_database.db')
-
-# Create a cursor
-cursor = conn.cursor()
-
-# Create a table
-cursor.execute('''CREATE TABLE IF NOT EXISTS Data1 (
-                date_time TEXT DEFAULT CURRENT_TIMESTAMP,
-                relTime REAL NOT NULL,
-                temp1 REAL NOT NULL,
-                temp2 REAL NOT NULL,
-                temp3 REAL,
-                temp4 REAL,
-                temp5 REAL,
-                temp6 REAL,
-                temp7 REAL,
-                temp8 REAL,
-                power REAL)''')
-
-# Create chandle and status ready for use
-chandle = ctypes.c_int16()
-status = {}
-
-# open unit
-status["open_unit"] = tc08.usb_tc08_open_unit()
-assert_pico2000_ok(status["open_unit"])
-chandle = status["open_unit"]
-
-# set mains rejection to 50 Hz
-status["set_mains"] = tc08.usb_tc08_set_mains(chandle, 0)
-assert_pico2000_ok(status["set_mains"])
-
-# set up channel
 # thermocouples types and int8 equivalent
 # B=66 , E=69 , J=74 , K=75 , N=78 , R=82 , S=83 , T=84 , ' '=32 , X=88
 typeK = ctypes.c_int8(75)
 typeNA = ctypes.c_int8(32)
-for i in range(OPEN_CHANNELS):
-    status["set_channel"] = tc08.usb_tc08_set_channel(chandle, i + 1, typeK)
-assert_pico2000_ok(status["set_channel"])
-
-# Set up variables to read temperature
-temp = (ctypes.c_float * 9)()
-overflow = ctypes.c_int16(0)
 units = tc08.USBTC08_UNITS["USBTC08_UNITS_CENTIGRADE"]
 
-# Set up variables for timing, loop control
-start_time = time.time()
-large_read_counter = 0
-vals_to_print = OPEN_CHANNELS + 1
-
-# Loop to collect temperature data
-while 1:
-    # Increment counter until reading of more TCs
-    large_read_counter += 1
-
-    # Large TC Read
-    if large_read_counter == CYCLES_UNTIL_LARGE_READ:
-        vals_to_print = OPEN_CHANNELS + CHANNELS_TO_ADD + 1
-        # Add Channels
-        for i in range(OPEN_CHANNELS, OPEN_CHANNELS + CHANNELS_TO_ADD):
-            tc08.usb_tc08_set_channel(chandle, i + 1, typeK)
-        # Take TC Measurements
-        end_time = time.time()  # Must be right before get_single reading
-        tc08.usb_tc08_get_single(chandle, ctypes.byref(temp), ctypes.byref(overflow), units)
-        elapsed_time = end_time - start_time
-        # Take Power Measurement
-
-        # Insert Values
-        cursor.execute("INSERT INTO Data1 (relTime, temp1, temp2, temp3, temp4, temp5, temp6, temp7, temp8) "
-                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       (elapsed_time, temp[1], temp[2], temp[3], temp[4], temp[5], temp[6], temp[7], temp[8]))
-
-    # Normal (2) TC Read
-    else:
-        # Reset Large Read channels set to Normal Read
-        if large_read_counter == CYCLES_UNTIL_LARGE_READ + 1:
-            large_read_counter = 0
-            vals_to_print = OPEN_CHANNELS + 1
+
+def print_writer_stats(writer):
+    stats = writer.stats()
+    print(f"Writer: queue depth {stats['queue_depth']}, last flush {stats['last_flush_ms']:.1f} ms, "
+          f"max flush {stats['max_flush_ms']:.1f} ms, dropped {stats['dropped']}")
+
+
+def publish(ring, rel_times, temps, first_channel, detector=None):
+    # Ring buffer rows for readings of consecutive channels, NaN in every other unit's columns
+    # The steady state detector watches the same rows
+    temps = np.asarray(temps, dtype=np.float64).reshape(len(rel_times), -1)
+    rows = np.full((len(rel_times), ring.n_columns), np.nan)
+    rows[:, 0] = rel_times
+    rows[:, first_channel:first_channel + temps.shape[1]] = temps
+    ring.append(rows)
+    if detector is not None:
+        detector.add(rows[:, 0], rows[:, 1:])
+
+
+def poll_loop(chandle, writer, ring, status, run_id, stop_event, first_channel=1, start_time=None, detector=None):
+    # Open the 2 fast channels, the others are only switched on every CYCLES_UNTIL_LARGE_READ reads
+    for i in range(OPEN_CHANNELS):
+        status["set_channel"] = tc08.usb_tc08_set_channel(chandle, i + 1, typeK)
+    assert_pico2000_ok(status["set_channel"])
+
+    # Set up variables to read temperature
+    temp = (ctypes.c_float * 9)()
+    overflow = ctypes.c_int16(0)
+
+    # Set up variables for timing, loop control, units share the host start_time as their timeline
+    if start_time is None:
+        start_time = time.time()
+    last_stats_time = start_time
+    large_read_counter = 0
+    vals_to_print = OPEN_CHANNELS + 1
+
+    # Loop to collect temperature data
+    while not stop_event.is_set():
+        # Increment counter until reading of more TCs
+        large_read_counter += 1
+
+        # Large TC Read
+        if large_read_counter == CYCLES_UNTIL_LARGE_READ:
+            vals_to_print = OPEN_CHANNELS + CHANNELS_TO_ADD + 1
+            # Add Channels
             for i in range(OPEN_CHANNELS, OPEN_CHANNELS + CHANNELS_TO_ADD):
-                tc08.usb_tc08_set_channel(chandle, i + 1, typeNA)
-        # Take Measurements
-        end_time = time.time()
-        tc08.usb_tc08_get_single(chandle, ctypes.byref(temp), ctypes.byref(overflow), units)
-        elapsed_time = end_time - start_time
-        # Insert Values
-        cursor.execute("INSERT INTO Data1 (relTime, temp1, temp2) VALUES (?, ?, ?)",
-                       (elapsed_time, temp[1], temp[2]))
-
-    for channel in range(vals_to_print):
-        true_elapsed_time = elapsed_time + (TC_LAG * max(1, channel))
-        print(f"Channel {channel}: {temp[channel]}, Time: {true_elapsed_time}")
-
-    # Commit the changes to the database
-    conn.commit()
-
-# close unit
-status["close_unit"] = tc08.usb_tc08_close_unit(chandle)
-assert_pico2000_ok(status["close_unit"])
-
-# Close the cursor and the connection
-cursor.close()
-conn.close()
+                tc08.usb_tc08_set_channel(chandle, i + 1, typeK)
+            # Take TC Measurements
+            end_time = time.time()  # Must be right before get_single reading
+            tc08.usb_tc08_get_single(chandle, ctypes.byref(temp), ctypes.byref(overflow), units)
+            elapsed_time = end_time - start_time
+            # Take Power Measurement
+
+            # Queue Values
+            temps = temp[1:OPEN_CHANNELS + CHANNELS_TO_ADD + 1]
+            for row in db.sample_rows(run_id, elapsed_time, temps, first_channel):
+                writer.put(db.INSERT_SAMPLE, row)
+            publish(ring, [elapsed_time], temps, first_channel, detector)
+
+        # Normal (2) TC Read
+        else:
+            # Reset Large Read channels set to Normal Read
+            if large_read_counter == CYCLES_UNTIL_LARGE_READ + 1:
+                large_read_counter = 0
+                vals_to_print = OPEN_CHANNELS + 1
+                for i in range(OPEN_CHANNELS, OPEN_CHANNELS + CHANNELS_TO_ADD):
+                    tc08.usb_tc08_set_channel(chandle, i + 1, typeNA)
+            # Take Measurements
+            end_time = time.time()
+            tc08.usb_tc08_get_single(chandle, ctypes.byref(temp), ctypes.byref(overflow), units)
+            elapsed_time = end_time - start_time
+            # Queue Values
+            temps = temp[1:OPEN_CHANNELS + 1]
+            for row in db.sample_rows(run_id, elapsed_time, temps, first_channel):
+                writer.put(db.INSERT_SAMPLE, row)
+            publish(ring, [elapsed_time], temps, first_channel, detector)
+
+        for channel in range(vals_to_print):
+            true_elapsed_time = elapsed_time + (TC_LAG * max(1, channel))
+            print(f"Channel {channel + first_channel - 1 if channel else 'CJ'}: {temp[channel]}, Time: {true_elapsed_time}")
+
+        # Report how far behind the writer is
+        if end_time - last_stats_time >= STATS_INTERVAL:
+            last_stats_time = end_time
+            print_writer_stats(writer)
+
+
+def stream_loop(chandle, writer, ring, status, run_id, stop_event, first_channel=1, start_time=None,
+                detector=None):
+    # Every channel stays open for the whole run, the TC-08 samples them all each interval
+    channels = list(range(1, OPEN_CHANNELS + CHANNELS_TO_ADD + 1))
+    for channel in channels:
+        status["set_channel"] = tc08.usb_tc08_set_channel(chandle, channel, typeK)
+        assert_pico2000_ok(status["set_channel"])
+    db_channels = [channel + first_channel - 1 for channel in channels]
+
+    # get minimum sampling interval in ms for the open channels
+    status["get_minimum_interval_ms"] = tc08.usb_tc08_get_minimum_interval_ms(chandle)
+    assert_pico2000_ok(status["get_minimum_interval_ms"])
+    interval_ms = status["get_minimum_interval_ms"]
+    if STREAM_WAKEUP * 1000 / interval_ms >= STREAM_BUFFER_SIZE:
+        raise ValueError("STREAM_WAKEUP is too long, the TC-08 buffer would overflow between reads")
+
+    # Record the rate the unit actually runs at with the run
+    writer.put(db.UPDATE_SAMPLING_RATE, (1000 / interval_ms, run_id))
+
+    # initialize ctype buffers
+    temp_buffer = (ctypes.c_float * STREAM_BUFFER_SIZE)()
+    times_ms_buffer = (ctypes.c_int32 * STREAM_BUFFER_SIZE)()
+    overflow = ctypes.c_int16()
+
+    # Readings drained from each channel that are not written yet, as (time ms, temp)
+    pending = {channel: [] for channel in channels}
+    last_time_ms = None
+    lost = 0
+
+    # set tc-08 running
+    # Its clock starts at usb_tc08_run, with several units the midpoint of the call against the shared
+    # start_time is the offset that puts this unit's readings on the common timeline
+    run_called = time.time()
+    status["run"] = tc08.usb_tc08_run(chandle, interval_ms)
+    run_returned = time.time()
+    assert_pico2000_ok(status["run"])
+    clock_offset = 0.0 if start_time is None else (run_called + run_returned) / 2 - start_time
+    print(f"Streaming channels {db_channels[0]}-{db_channels[-1]} every {interval_ms} ms, "
+          f"clock offset {clock_offset:.3f} s")
+
+    last_stats_time = time.time()
+    try:
+        while not stop_event.is_set():
+            time.sleep(STREAM_WAKEUP)
+
+            # Drain everything buffered on every channel
+            for channel in channels:
+                count = tc08.usb_tc08_get_temp_deskew(chandle, ctypes.byref(temp_buffer),
+                                                      ctypes.byref(times_ms_buffer), STREAM_BUFFER_SIZE,
+                                                      ctypes.byref(overflow), channel, units, 1)
+                if count < 0:
+                    raise RuntimeError(f"usb_tc08_get_temp_deskew failed on channel {channel}")
+                pending[channel].extend(zip(times_ms_buffer[:count], temp_buffer[:count]))
+
+            # Deskewed readings line up by index, write every complete set and keep the rest for the next wakeup
+            ready = min(len(readings) for readings in pending.values())
+            rows = []
+            for i in range(ready):
+                time_ms = pending[channels[0]][i][0]
+                # Gaps in the device clock mean the buffer overflowed between wakeups
+                if last_time_ms is not None and time_ms - last_time_ms > 1.5 * interval_ms:
+                    lost += round((time_ms - last_time_ms) / interval_ms) - 1
+                last_time_ms = time_ms
+                row = [time_ms / 1000 + clock_offset] + [pending[channel][i][1] for channel in channels]
+                for channel, temp in zip(db_channels, row[1:]):
+                    writer.put(db.INSERT_SAMPLE, (run_id, channel, row[0], temp))
+                rows.append(row)
+            for channel in channels:
+                del pending[channel][:ready]
+            if rows:
+                rows = np.array(rows)
+                publish(ring, rows[:, 0], rows[:, 1:], first_channel, detector)
+
+            if ready:
+                for channel, temp in zip(db_channels, row[1:]):
+                    print(f"Channel {channel}: {temp}, Time: {row[0]}")
+                print(f"{ready} readings, {lost} lost")
+
+            now = time.time()
+            if now - last_stats_time >= STATS_INTERVAL:
+                last_stats_time = now
+                print_writer_stats(writer)
+    finally:
+        status["stop"] = tc08.usb_tc08_stop(chandle)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["stream", "poll"], default=ACQUISITION_MODE)
+    parser.add_argument("--units", type=int, default=1, help="Number of TC-08 units to read together")
+    parser.add_argument("--db", default=DATABASE_NAME)
+    parser.add_argument("--ring", default=RING_BUFFER_PATH, help="Ring buffer file the dashboard reads live data from")
+    db.add_run_arguments(parser)
+    args = parser.parse_args()
+
+    # Connect to the database (WAL mode), only used to create the tables and the run
+    conn = connect(args.db)
+    db.create_tables(conn)
+    # Stream mode deskews the readings so every channel has its own time, poll mode reads the channels one after another
+    run_id = db.create_run_from_args(conn, args, POLL_SAMPLING_RATE if args.mode == "poll" else None,
+                                     db.TC_TIME_SHIFT if args.mode == "poll" else 0)
+    conn.close()
+    print(f"Recording run {run_id}")
+
+    # Samples are handed to the writer thread so the loop never waits on disk
+    writer = SampleWriter(args.db)
+    writer.start()
+
+    # Newest samples are also published to the shared memory ring buffer for the dashboard
+    channels_per_unit = OPEN_CHANNELS + CHANNELS_TO_ADD
+    ring = RingBuffer.create(args.ring, n_channels=channels_per_unit * args.units, run_id=run_id)
+
+    # Stores when the run settles into periodic steady state, watching the placed TCs (TC1 and TC2 by default)
+    # It is queued from a thread of its own, the acquisition thread that found it never waits on the writer
+    steady_threads = []
+
+    def on_steady(steady_time):
+        thread = threading.Thread(target=writer.put, args=(db.UPDATE_STEADY_TIME, (steady_time, run_id), True),
+                                  name="steady-time", daemon=True)
+        thread.start()
+        steady_threads.append(thread)
+        print(f"Steady state from {steady_time:.1f} s")
+
+    watched = range(1, len(args.positions) + 1) if args.positions else (1, 2)
+    detector = SteadyStateDetector(args.frequency, watched, on_steady=on_steady)
+
+    # Create chandles and statuses ready for use, one per unit
+    chandles = []
+    statuses = []
+
+    for unit in range(args.units):
+        status = {}
+
+        # open unit
+        status["open_unit"] = tc08.usb_tc08_open_unit()
+        assert_pico2000_ok(status["open_unit"])
+        chandle = status["open_unit"]
+
+        # set mains rejection to 50 Hz
+        status["set_mains"] = tc08.usb_tc08_set_mains(chandle, 0)
+        assert_pico2000_ok(status["set_mains"])
+
+        chandles.append(chandle)
+        statuses.append(status)
+
+    # One worker per unit, all on the same timeline (single units keep their own device/host clock)
+    loop = stream_loop if args.mode == "stream" else poll_loop
+    stop_event = threading.Event()
+    start_time = time.time() if args.units > 1 else None
+
+    def worker(unit):
+        try:
+            loop(chandles[unit], writer, ring, statuses[unit], run_id, stop_event,
+                 unit * channels_per_unit + 1, start_time, detector)
+        except Exception as e:
+            print(f"Unit {unit} stopped: {e}")
+            stop_event.set()
+
+    workers = [threading.Thread(target=worker, args=(unit,), name=f"TC08-{unit}", daemon=True)
+               for unit in range(args.units)]
+    for thread in workers:
+        thread.start()
+
+    # Ctrl+C to stop
+    try:
+        while any(thread.is_alive() for thread in workers):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        stop_event.set()
+    for thread in workers:
+        thread.join()
+
+    # close units
+    for chandle, status in zip(chandles, statuses):
+        status["close_unit"] = tc08.usb_tc08_close_unit(chandle)
+        assert_pico2000_ok(status["close_unit"])
+
+    # Write out the remaining queued samples
+    ring.close()
+    for thread in steady_threads:
+        thread.join()
+    writer.stop()